@@ -0,0 +1,156 @@
+"""
+Reconciles users, groups and authorized_keys on a host in one step.
+
+The wanted accounts are worked out locally: a dict of username to its shell,
+groups and ssh keys, with the keys read from the local key files and
+deduplicated. sync() sends them, with a small python script, to the host in
+a single batch step. The script creates missing groups and users, adds
+missing group memberships, fixes shells and merges the keys into each
+authorized_keys, dropping duplicate lines. Keys already on the host are
+kept. It prints what it changed, and nothing for accounts that were already
+right.
+"""
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import base64
+
+from fabric.api import env
+from fabric.colors import green
+from louis import conf
+import louis.batch
+
+SCRIPT = r"""
+import grp, json, os, pwd, subprocess
+
+wanted = json.loads(%r)
+
+def call(*args):
+    subprocess.check_call(args)
+
+def shell_path(shell):
+    if shell.startswith('/'):
+        return shell
+    for directory in ('/bin', '/usr/bin', '/usr/local/bin'):
+        if os.path.exists(os.path.join(directory, shell)):
+            return os.path.join(directory, shell)
+    return '/bin/' + shell
+
+def unique(lines):
+    seen = set()
+    result = []
+    for line in lines:
+        line = line.strip()
+        if line and line not in seen:
+            seen.add(line)
+            result.append(line)
+    return result
+
+for group in wanted['groups']:
+    try:
+        grp.getgrnam(group)
+    except KeyError:
+        call('groupadd', group)
+        print 'group %%s created' %% group
+
+for name in sorted(wanted['users']):
+    user = wanted['users'][name]
+    shell = shell_path(user['shell'])
+    try:
+        entry = pwd.getpwnam(name)
+    except KeyError:
+        args = ['useradd', '-m', '-s', shell]
+        if user['groups']:
+            args.extend(['-G', ','.join(user['groups'])])
+        call(*args + [name])
+        entry = pwd.getpwnam(name)
+        print '%%s created' %% name
+    else:
+        if entry.pw_shell != shell:
+            call('usermod', '-s', shell, name)
+            print '%%s: shell set to %%s' %% (name, shell)
+        member_of = [g.gr_name for g in grp.getgrall() if name in g.gr_mem]
+        missing = [g for g in user['groups'] if g not in member_of]
+        if missing:
+            call('usermod', '-a', '-G', ','.join(missing), name)
+            print '%%s: added to %%s' %% (name, ', '.join(missing))
+    ssh_dir = os.path.join(entry.pw_dir, '.ssh')
+    path = os.path.join(ssh_dir, 'authorized_keys')
+    existing = []
+    if os.path.exists(path):
+        existing = [l.strip() for l in open(path) if l.strip()]
+    keys = unique(existing + user['keys'])
+    if keys == existing:
+        continue
+    if not os.path.isdir(ssh_dir):
+        os.makedirs(ssh_dir)
+    keys_file = open(path, 'w')
+    keys_file.write(''.join(k + '\n' for k in keys))
+    keys_file.close()
+    for p, mode in ((ssh_dir, 0700), (path, 0600)):
+        os.chown(p, entry.pw_uid, entry.pw_gid)
+        os.chmod(p, mode)
+    added = len(keys) - len(unique(existing))
+    print '%%s: %%d keys added, %%d duplicates removed' %% (
+        name, added, len(existing) - len(unique(existing)))
+"""
+
+
+def read_keys(*paths):
+    """Returns the keys in the local key files, without duplicates."""
+    keys = []
+    for path in paths:
+        for line in open(path).read().splitlines():
+            line = line.strip()
+            if line and not line.startswith('#') and line not in keys:
+                keys.append(line)
+    return keys
+
+
+def account(keys, shell='bash', groups=()):
+    return {'shell': shell, 'groups': list(groups), 'keys': list(keys)}
+
+
+def sysadmins():
+    """The accounts for louisconf.SYSADMINS, members of the admin group."""
+    return dict((name, account(read_keys(s['ssh_key_path']), s['shell'], ['admin']))
+                for name, s in conf.SYSADMINS.items())
+
+
+def sysadmin_keys():
+    """Every sysadmin's keys, for accounts they all log in to."""
+    return read_keys(*[s['ssh_key_path'] for s in conf.SYSADMINS.values()])
+
+
+def script(accounts):
+    groups = []
+    for spec in accounts.values():
+        groups.extend(g for g in spec['groups'] if g not in groups)
+    return SCRIPT % json.dumps({'users': accounts, 'groups': groups})
+
+
+def report(output, accounts):
+    """Prints and returns the changes in the output of a sync step."""
+    changes = [l for l in output.splitlines() if l.strip()]
+    for change in changes:
+        print(green('[%s] %s' % (env.host_string, change)))
+    if not changes:
+        print(green('[%s] %d accounts up to date' % (env.host_string, len(accounts))))
+    return changes
+
+
+def sync(accounts, batch=None):
+    """
+    Brings the accounts (username -> account()) in line on the host and
+    returns the changes. With a batch, the step is only added to it; pass
+    its output to report().
+    """
+    command = 'echo %s | base64 -d | python' % base64.b64encode(script(accounts))
+    if batch is not None:
+        batch.add(command)
+        return
+    batch = louis.batch.Batch()
+    batch.add(command)
+    return report(batch.run(quiet=True)[0], accounts)
@@ -0,0 +1,230 @@
+"""
+Collects the project's static files once and ships them precompressed.
+
+build() runs collectstatic in the local checkout, with a settings shim that
+points STATIC_ROOT at louisconf.ASSETS_DIR (~/.louis/assets), one directory
+per commit and settings module, so every host of a deploy gets the same
+build and it only happens once, also when parallel runs a fab process per
+host: the first one builds while the others wait on a lock. Text assets get a .gz variant, and a .br
+variant when the brotli module is importable, and a manifest maps every
+file to its sha1.
+
+ship() compares that manifest with the one left on the host by the last
+ship, sends the changed files in one tarball and removes the ones that went
+away. APACHE_TEMPLATE makes apache serve the variants to clients that
+accept them, without compressing anything itself.
+"""
+from __future__ import with_statement
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from fabric.api import env, sudo, put, local, settings, hide
+from fabric.colors import green
+from louis import conf
+from louis import workers
+import louis.batch
+
+MANIFEST = '.louis-assets.json'
+
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.html', '.txt',
+                '.xml', '.ico', '.eot', '.ttf', '.otf')
+
+APACHE_TEMPLATE = """# Generated by louis: serves precompressed static files.
+<Directory "%(static_root)s">
+    Options +FollowSymLinks
+    RewriteEngine On
+    RewriteBase %(static_url)s
+    RewriteCond %%{HTTP:Accept-Encoding} br
+    RewriteCond %%{REQUEST_FILENAME}.br -f
+    RewriteRule ^(.+)$ $1.br [L,E=no-gzip:1]
+    RewriteCond %%{HTTP:Accept-Encoding} gzip
+    RewriteCond %%{REQUEST_FILENAME}.gz -f
+    RewriteRule ^(.+)$ $1.gz [L,E=no-gzip:1]
+    <FilesMatch "\\.gz$">
+        RemoveType .gz
+        AddEncoding gzip .gz
+    </FilesMatch>
+    <FilesMatch "\\.br$">
+        RemoveType .br
+        AddEncoding br .br
+    </FilesMatch>
+    Header append Vary Accept-Encoding
+</Directory>
+"""
+
+SHIM = """from %(django_settings)s import *
+STATIC_ROOT = %(static_root)r
+"""
+
+_builds = {}
+
+
+def _cache_dir():
+    return os.path.expanduser(getattr(conf, 'ASSETS_DIR', '~/.louis/assets'))
+
+
+def _sha1(path):
+    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+
+
+def _compress(path):
+    """Writes the compressed variants of path that are smaller than it."""
+    data = open(path, 'rb').read()
+    variants = []
+    handle = open(path + '.gz', 'wb')
+    try:
+        # no name or mtime in the header, so the same input gives the same bytes
+        compressed = gzip.GzipFile('', 'wb', 9, handle, 0)
+        compressed.write(data)
+        compressed.close()
+    finally:
+        handle.close()
+    variants.append(path + '.gz')
+    if brotli is not None:
+        open(path + '.br', 'wb').write(brotli.compress(data))
+        variants.append(path + '.br')
+    for variant in variants:
+        if os.path.getsize(variant) >= len(data):
+            os.remove(variant)
+
+
+def _settings_value(django_settings, name):
+    return local('DJANGO_SETTINGS_MODULE=%s python -c '
+                 '"from django.conf import settings; print settings.%s"'
+                 % (django_settings, name)).strip()
+
+
+def _collect(django_settings, build_dir):
+    shim_name = 'louis_assets_settings_%d' % os.getpid()
+    shim = open('%s.py' % shim_name, 'w')
+    try:
+        shim.write(SHIM % {'django_settings': django_settings,
+                           'static_root': build_dir})
+    finally:
+        shim.close()
+    try:
+        local('python manage.py collectstatic --noinput --settings=%s >/dev/null'
+              % shim_name)
+    finally:
+        for path in ('%s.py' % shim_name, '%s.pyc' % shim_name):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def build(django_settings):
+    """
+    Returns the local build directory and manifest for the checkout's
+    current commit, collecting and compressing the static files if they
+    aren't cached yet.
+    """
+    head = local('git rev-parse HEAD').strip()
+    key = '%s-%s' % (head, django_settings)
+    if key in _builds:
+        return _builds[key]
+    build_dir = os.path.join(_cache_dir(), key)
+    manifest_path = os.path.join(build_dir, MANIFEST)
+    with workers.locked(build_dir + '.lock'):
+        if not os.path.exists(manifest_path):
+            _build(django_settings, head, build_dir)
+    _builds[key] = (build_dir, json.load(open(manifest_path)))
+    return _builds[key]
+
+
+def _build(django_settings, head, build_dir):
+    print(green('Collecting static files for %s' % head[:10]))
+    partial = tempfile.mkdtemp(prefix=os.path.basename(build_dir) + '.',
+                               dir=_cache_dir())
+    try:
+        os.chmod(partial, 0755)
+        _collect(django_settings, partial)
+        manifest = {}
+        for directory, dirs, filenames in os.walk(partial):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if filename.endswith(COMPRESSIBLE):
+                    _compress(path)
+        for directory, dirs, filenames in os.walk(partial):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                manifest[path[len(partial) + 1:]] = _sha1(path)
+        manifest_file = open(os.path.join(partial, MANIFEST), 'w')
+        try:
+            json.dump(manifest, manifest_file, indent=0, sort_keys=True)
+        finally:
+            manifest_file.close()
+        if os.path.isdir(build_dir):
+            # left by a build that didn't finish
+            shutil.rmtree(build_dir)
+        os.rename(partial, build_dir)
+    finally:
+        if os.path.isdir(partial):
+            shutil.rmtree(partial)
+
+
+def static_location(django_settings):
+    """Returns STATIC_ROOT and STATIC_URL, from louisconf or the settings."""
+    static_root = getattr(conf, 'STATIC_ROOT', None) or \
+        _settings_value(django_settings, 'STATIC_ROOT')
+    static_url = getattr(conf, 'STATIC_URL', None) or \
+        _settings_value(django_settings, 'STATIC_URL')
+    return static_root.rstrip('/'), static_url
+
+
+def ship(build_dir, manifest, static_root, owner):
+    """
+    Brings the host's static_root in line with the build and returns the
+    number of files sent.
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = sudo('cat %s/%s' % (static_root, MANIFEST))
+    try:
+        shipped = json.loads(output)
+    except ValueError:
+        shipped = {}
+    changed = sorted(p for p, digest in manifest.items() if shipped.get(p) != digest)
+    removed = sorted(p for p in shipped if p not in manifest)
+    if not changed and not removed:
+        print(green('[%s] %d static files up to date' % (env.host_string, len(manifest))))
+        return 0
+    batch = louis.batch.Batch()
+    if changed:
+        handle, archive = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(handle)
+        tarball = tarfile.open(archive, 'w:gz')
+        try:
+            for path in changed + [MANIFEST]:
+                tarball.add(os.path.join(build_dir, path), path)
+        finally:
+            tarball.close()
+        remote_archive = '/tmp/louis-assets-%s.tar.gz' % batch.token[8:]
+        try:
+            put(archive, remote_archive)
+        finally:
+            os.remove(archive)
+        batch.add('mkdir -p %s && tar xzf %s -C %s && rm -f %s' % (
+            static_root, remote_archive, static_root, remote_archive))
+    else:
+        batch.write(open(os.path.join(build_dir, MANIFEST)).read(),
+                    '%s/%s' % (static_root, MANIFEST))
+    for start in range(0, len(removed), 200):
+        batch.add('cd %s && rm -f %s' % (static_root, ' '.join(
+            louis.batch.quote(p) for p in removed[start:start + 200])))
+    batch.add('chown -R %s:www-data %s' % (owner, static_root))
+    batch.run(quiet=True)
+    print(green('[%s] shipped %d static files, removed %d' %
+                (env.host_string, len(changed), len(removed))))
+    return len(changed)
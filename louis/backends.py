@@ -0,0 +1,167 @@
+"""
+Execution backends for louis tasks.
+
+By default louis talks to real hosts through fabric. The recording backend
+replaces fabric's operations with fakes that only write down what would have
+been done, so any task can run in plan mode without a server: it prints the
+exact commands, how many round trips they cost and how many bytes they move.
+
+The fake host answers every command with empty output and success, which
+takes the "fresh box" path through most tasks. Batches (see louis.batch) are
+understood, so each of their steps reports success and is listed. Responses
+can be scripted with louisconf.PLAN_RESPONSES, a list of (regex, output)
+pairs; an output of None makes the command fail. louisconf.PLAN_LATENCY adds
+a simulated round trip time in seconds, to turn round trips into wall time.
+"""
+import base64
+import os
+import re
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fabric.api import env
+from louis import conf
+from louis import patching
+
+_installed = []
+
+_batch_command = re.compile(r'^echo (\S+) \| base64 -d \| /bin/bash$')
+_batch_marker = re.compile(r"printf '\\n(@@louis-[0-9a-f]+ \d+) exit")
+
+
+class Result(str):
+    """Mimics the strings fabric operations return."""
+
+    def __new__(cls, output='', failed=False):
+        result = str.__new__(cls, output)
+        result.failed = failed
+        result.succeeded = not failed
+        result.return_code = failed and 1 or 0
+        return result
+
+
+class RecordingBackend(object):
+
+    def __init__(self, responses=None, latency=None):
+        if responses is None:
+            responses = getattr(conf, 'PLAN_RESPONSES', [])
+        self.responses = [(re.compile(r), o) for r, o in responses]
+        if latency is None:
+            latency = getattr(conf, 'PLAN_LATENCY', 0)
+        self.latency = float(latency)
+        self.operations = []
+
+    def _record(self, kind, command, transferred=0, steps=None):
+        self.operations.append({
+            'kind': kind,
+            'host': env.host_string or 'local',
+            'command': command,
+            'bytes': transferred + len(command),
+            'steps': steps or [],
+        })
+        if kind != 'local' and self.latency:
+            time.sleep(self.latency)
+
+    def _respond(self, command):
+        for regex, output in self.responses:
+            if regex.search(command):
+                if output is None:
+                    return Result('', failed=True)
+                return Result(output)
+        return Result()
+
+    def _command(self, kind, command):
+        match = _batch_command.match(command)
+        if not match:
+            self._record(kind, command)
+            return self._respond(command)
+        # a louis batch: list its steps and make every one of them succeed
+        script = base64.b64decode(match.group(1))
+        suffix = ' ) 2>&1 </dev/null'
+        steps = [l[2:-len(suffix)] for l in script.splitlines()
+                 if l.startswith('( ') and l.endswith(suffix)]
+        self._record(kind, command, steps=steps)
+        markers = _batch_marker.findall(script)
+        return Result(''.join('\n%s exit 0\n' % m for m in markers))
+
+    def run(self, command, *args, **kwargs):
+        return self._command('run', command)
+
+    def sudo(self, command, *args, **kwargs):
+        return self._command('sudo', command)
+
+    def local(self, command, *args, **kwargs):
+        self._record('local', command)
+        return self._respond(command)
+
+    def put(self, local_path, remote_path, *args, **kwargs):
+        try:
+            size = os.path.getsize(local_path)
+        except OSError:
+            size = 0
+        self._record('put', '%s -> %s' % (local_path, remote_path), size)
+        return Result()
+
+    def get(self, remote_path, local_path, *args, **kwargs):
+        self._record('get', '%s -> %s' % (remote_path, local_path))
+        return Result()
+
+    def prompt(self, text, *args, **kwargs):
+        return kwargs.get('default', '')
+
+    def confirm(self, question, default=True):
+        # never take destructive branches in plan mode
+        return False
+
+    def round_trips(self):
+        return len([o for o in self.operations if o['kind'] != 'local'])
+
+    def report(self):
+        """Returns the numbers a plan is judged by."""
+        return {
+            'round_trips': self.round_trips(),
+            'commands': sum(max(1, len(o['steps'])) for o in self.operations
+                            if o['kind'] != 'local'),
+            'bytes': sum(o['bytes'] for o in self.operations),
+            'operations': self.operations,
+        }
+
+    def print_plan(self):
+        for number, operation in enumerate(self.operations):
+            print('%4d %-5s [%s] %s' % (number + 1, operation['kind'],
+                                        operation['host'],
+                                        operation['command'][:150]))
+            for step in operation['steps']:
+                print('            | %s' % step[:140])
+        report = self.report()
+        print('%d round trips, %d remote commands, %d bytes sent' %
+              (report['round_trips'], report['commands'], report['bytes']))
+
+    def save(self, path):
+        report_file = open(path, 'w')
+        try:
+            json.dump(self.report(), report_file, indent=1)
+        finally:
+            report_file.close()
+
+
+def install(backend):
+    """Makes every louis task use backend instead of fabric's operations."""
+    from fabric import api
+    from fabric.contrib import console
+    replacements = {}
+    for name in ('run', 'sudo', 'put', 'get', 'local', 'prompt'):
+        replacements[getattr(api, name)] = getattr(backend, name)
+    replacements[console.confirm] = backend.confirm
+    patching.rebind_everywhere(replacements)
+    _installed.append(backend)
+    return backend
+
+
+def installed():
+    """The backend tasks run with, or None when they talk to real hosts."""
+    return _installed and _installed[-1] or None
@@ -0,0 +1,199 @@
+"""
+Runs a sequence of shell commands on the remote host in one round trip.
+
+Commands are added to a Batch and compiled into a single bash script. The
+script is shipped base64 encoded inside the command line (or uploaded first
+when it is too big for that), so running it costs one run()/sudo() call
+instead of one per command. Every step prints a marker with its exit code,
+which is used to split the output back per step. A failing step stops the
+script unless it was added with warn_only=True, just like fabric would.
+"""
+from __future__ import with_statement
+import base64
+import os
+import random
+import re
+import tempfile
+from contextlib import contextmanager
+
+from fabric.api import env, run, sudo, put, settings, hide
+from fabric.utils import abort
+
+# Linux refuses single arguments bigger than 128k
+_MAX_INLINE_SCRIPT = 100000
+
+
+def quote(text):
+    """Quotes text for the shell with single quotes."""
+    return "'%s'" % str(text).replace("'", "'\\''")
+
+
+class StepResult(str):
+    """
+    Output of a single step. Like fabric's results, it's a string with a
+    failed attribute, plus the step's command and exit code.
+    """
+
+    def __new__(cls, output, number, command, exit_code):
+        result = str.__new__(cls, output)
+        result.number = number
+        result.command = command
+        result.exit_code = exit_code
+        result.failed = exit_code != 0
+        return result
+
+
+class Batch(object):
+
+    def __init__(self, use_sudo=True, user=None):
+        self.use_sudo = use_sudo
+        self.user = user
+        self.steps = []
+        self.results = []
+        self.token = '@@louis-%08x' % random.getrandbits(32)
+        self._guards = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, command, warn_only=False, user=None):
+        """
+        Adds a command. It runs in the directory given by any enclosing
+        cd() and, if user is given, as that user from their home directory.
+        """
+        if user:
+            command = 'sudo -u %s -H /bin/bash -c %s' % (
+                user, quote('cd ~%s && %s' % (user, command)))
+        elif env.cwd:
+            command = 'cd %s && %s' % (env.cwd, command)
+        self.steps.append(('run', command, warn_only or env.warn_only,
+                           tuple(self._guards)))
+
+    @contextmanager
+    def unless(self, check):
+        """
+        Steps added inside the block are skipped when the check command
+        succeeds. The check runs once, when the script gets to it.
+        """
+        self._guards.append(len(self.steps))
+        self.steps.append(('check', check, True, ()))
+        try:
+            yield
+        finally:
+            self._guards.pop()
+
+    def append(self, lines, filename, warn_only=False, user=None):
+        """Appends lines to filename unless they're already there."""
+        if isinstance(lines, basestring):
+            lines = [lines]
+        for line in lines:
+            self.add('grep -qxF -- %s %s || echo %s >> %s' % (
+                quote(line), filename, quote(line), filename), warn_only,
+                user)
+
+    def sed(self, filename, before, after, limit='', warn_only=False):
+        """Same as fabric.contrib.files.sed, including the .bak backup."""
+        if limit:
+            limit = r'/%s/ ' % limit
+        expr = r'%ss/%s/%s/g' % (limit, before, after)
+        self.add('sed -i.bak -r -e %s %s' % (quote(expr), filename),
+                 warn_only)
+
+    def write(self, content, filename, append=False, warn_only=False):
+        """Writes (or appends) the local content to the remote filename."""
+        self.add('echo %s | base64 -d %s %s' % (
+            base64.b64encode(content), append and '>>' or '>', filename),
+            warn_only)
+
+    def script(self):
+        lines = ['#!/bin/bash']
+        for number, (kind, command, warn_only, guards) in \
+                enumerate(self.steps):
+            if kind == 'check':
+                lines.append('( %s ) >/dev/null 2>&1; skip_%d=$?' %
+                             (command, number))
+                continue
+            marker = '%s %d' % (self.token, number)
+            step = ['( %s ) 2>&1 </dev/null' % command,
+                    "rc=$?; printf '\\n%s exit %%d\\n' $rc" % marker]
+            if not warn_only:
+                step.append('[ $rc -eq 0 ] || exit $rc')
+            if guards:
+                condition = ' && '.join('[ $skip_%d -ne 0 ]' % g
+                                        for g in guards)
+                step = (['if %s; then' % condition] + step +
+                        ["else printf '\\n%s skip\\n'; fi" % marker])
+            lines.extend(step)
+        return '\n'.join(lines) + '\n'
+
+    def _execute(self, script):
+        operation = self.use_sudo and sudo or run
+        kwargs = {}
+        if self.use_sudo and self.user:
+            kwargs['user'] = self.user
+        if len(script) < _MAX_INLINE_SCRIPT:
+            command = 'echo %s | base64 -d | /bin/bash' % (
+                base64.b64encode(script))
+        else:
+            remote_path = '/tmp/louis-batch-%s.sh' % self.token[8:]
+            put_script(script, remote_path)
+            command = '/bin/bash %s; rc=$?; rm -f %s; exit $rc' % (
+                remote_path, remote_path)
+        with settings(hide('running', 'stdout'), warn_only=True):
+            with settings(cwd=''):
+                return operation(command, **kwargs)
+
+    def _split(self, output):
+        pattern = re.compile(r'^%s (\d+) (exit (\d+)|skip)$' %
+                             re.escape(self.token), re.M)
+        results = []
+        start = 0
+        for match in pattern.finditer(output):
+            number = int(match.group(1))
+            if match.group(2) == 'skip':
+                start = match.end() + 1
+                continue
+            text = output[start:match.start()]
+            if text.endswith('\n'):
+                text = text[:-1]
+            results.append(StepResult(text.strip('\r\n'), number,
+                                      self.steps[number][1],
+                                      int(match.group(3))))
+            start = match.end() + 1
+        return results
+
+    def run(self, quiet=False):
+        """
+        Runs the batch and returns one result per step that ran, skipped
+        steps have no result. Aborts on
+        the first failing step that wasn't added with warn_only.
+        """
+        if not self.steps:
+            return []
+        print('[%s] running %d commands in one batch' %
+              (env.host_string,
+               len([step for step in self.steps if step[0] == 'run'])))
+        output = self._execute(self.script())
+        self.results = self._split(output)
+        for result in self.results:
+            if not quiet:
+                print('[%s] batch: %s' % (env.host_string, result.command))
+                for line in result.splitlines():
+                    print('[%s] out: %s' % (env.host_string, line))
+            if result.failed and not self.steps[result.number][2]:
+                abort('batch step failed (return code %d) while executing '
+                      '%r' % (result.exit_code, result.command))
+        if output.failed and not self.results:
+            abort('batch could not be run: %s' % output)
+        return self.results
+
+
+def put_script(script, remote_path):
+    """Uploads the script text to remote_path through a local temp file."""
+    handle, path = tempfile.mkstemp()
+    try:
+        os.write(handle, script)
+        os.close(handle)
+        put(path, remote_path)
+    finally:
+        os.remove(path)
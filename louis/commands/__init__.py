@@ -1,15 +1,29 @@
-from fabric.api import env
+import atexit
+
+from fabric.api import env, abort
 
 from louis.commands.packages import *
 from louis.commands.users import *
 from louis.commands.projects import *
 from louis.commands.projects import *
 from louis.commands.databases import *
+from louis.commands.fleet import *
+from louis.commands.releases import *
+from louis.commands.benchmarks import *
+from louis.commands.graphs import *
+from louis.commands.packages import _server_packages, _wants_memcached
 from louis import conf
-
-# This is a new config added by Louis. In order to avoid problems on
-# commands using it, let's initialize it here.
-env.host_config = {}
+from louis import connections
+from louis import facts
+from louis import inventory
+from louis import state
+from louis import trace as tracing
+from louis import backends
+import louis.batch
+
+# This is a new config added by Louis. It follows whichever host fabric is
+# connected to, see louis.inventory.
+env.host_config = inventory.HostConfig()
 
 # Do not execute shell in login mode, so we can avoid warnings about stdin
 # not being a tty. Currently, we don't depend on anything that requires a
@@ -18,6 +32,10 @@ env.host_config = {}
 #     Reference: http://docs.fabfile.org/en/0.9.1/faq.html
 env.shell = "/bin/bash -c"
 
+# Count the SSH connections and channels opened during the session and keep
+# the per-host connection alive between commands.
+connections.install()
+
 def install_ezl_dotfiles(user=None):
     user = user or env.user
     with settings(user=user):
@@ -43,17 +61,18 @@ def giddyup():
 
 deploy = giddyup
 
-def init_server(apache=True, postgres=True):
+def init_server(apache=True, postgres=True, memcached=None):
     """
-    Runs basic configuration of a virgin server.
+    Runs basic configuration of a virgin server. memcached defaults to
+    louisconf.MEMCACHED, and is always installed on hosts with the cache
+    role.
     """
-    if hasattr(conf, "timezone"):
-        set_timezone(conf.timezone)
-    sudo("dpkg-reconfigure locales")
-    sudo("update-locale LANG=en_US.UTF-8")
-    setup_hosts()
+    config_system()
     update()
+    # one dpkg query for everything below
+    plan_packages("debconf-utils", *_server_packages(apache, postgres))
     install_debconf_seeds()
+    install_server_packages(apache, postgres)
     install_basic_packages()
     config_apticron()
     config_exim()
@@ -63,14 +82,48 @@ def init_server(apache=True, postgres=True):
         install_apache()
     if postgres:
         install_postgres()
+    if _wants_memcached(memcached):
+        install_memcached()
     config_sshd()
 
-def setup_hosts():
+@state.step(lambda: getattr(conf, "timezone", None),
+            inventory.hostname)
+def config_system():
+    """
+    Sets the timezone, the locale and the hostname in one go.
+    """
+    batch = louis.batch.Batch()
+    if hasattr(conf, "timezone"):
+        set_timezone(conf.timezone, batch=batch)
+    batch.add("dpkg-reconfigure locales")
+    batch.add("update-locale LANG=en_US.UTF-8")
+    setup_hosts(batch=batch)
+    batch.run()
+
+
+def force_steps():
+    """
+    Runs every provisioning step of the subsequent commands, even the ones
+    that already ran with the same inputs, e.g. fab web1 force_steps init_server
+    """
+    env.force_steps = True
+
+
+def forget_steps(name=None):
+    """
+    Forgets that provisioning steps ran on the host, all of them unless a
+    step name is given.
+    """
+    state.forget(name)
+
+
+def setup_hosts(batch=None):
     """
     Configure /etc/hosts and /etc/hostname. Make sure that env.host is the
     server's IP address and that env.hostname is the server's hostname.
     """
-    if not getattr(env, 'hostname', None):
+    hostname = inventory.hostname()
+    if not hostname:
         print "setup_hosts requires env.hostname. Skipping."
         return None
     ## the following stuff will only be necessary if we need to put entries
@@ -80,9 +133,14 @@ def setup_hosts():
     #import re
     #assert(re.search(r'^(\d{0,3}\.){3}\d{0,3}$', env.host) is not None)
     #files.append("%(host)s\t%(hostname)s" % env, '/etc/hosts', use_sudo=True)
-    files.append("127.0.1.1\t%s" % env.hostname, '/etc/hosts', use_sudo=True)
-    sudo("hostname %s" % env.hostname)
-    sudo('echo "%s" > /etc/hostname' % env.hostname)
+    own_batch = batch is None
+    if own_batch:
+        batch = louis.batch.Batch()
+    batch.append("127.0.1.1\t%s" % hostname, '/etc/hosts')
+    batch.add("hostname %s" % hostname)
+    batch.add('echo "%s" > /etc/hostname' % hostname)
+    if own_batch:
+        batch.run()
 
 
 def apache_reload():
@@ -102,21 +160,91 @@ def apache_restart():
     sudo('/etc/init.d/apache2 restart')
 
 
-def make_fxn(name, ip, config):
+def connection_stats():
+    """
+    Prints how many SSH connections and channels were opened so far. Use it
+    as the last task, e.g. fab web1 update_project connection_stats
+    """
+    connections.report()
+
+
+def show_facts():
+    """
+    Prints what louis knows about the host: users, groups, packages, apache
+    sites, CPUs, memory and OS release.
+    """
+    host_facts = facts.get()
+    for name in ('os', 'cpus', 'memory_mb'):
+        print('%-10s %s' % (name, host_facts[name]))
+    for name in ('users', 'groups', 'sites'):
+        print('%-10s %s' % (name, ' '.join(host_facts[name])))
+    print('%-10s %d installed' % ('packages', len(host_facts['packages'])))
+
+
+def forget_facts():
+    """Drops the cached facts of the host so the next task gathers them again."""
+    facts.invalidate()
+
+
+def trace():
+    """
+    Times every task and remote command that follows, e.g.
+    fab trace web1 update_project. A Chrome trace and the slowest steps are
+    written at the end. Set louisconf.TRACE = True to always trace.
+    """
+    tracing.install()
+
+
+def plan(report=None):
+    """
+    Runs the tasks that follow against a fake host and prints every command
+    they would run, with round trips and bytes sent, e.g.
+    fab web1 plan update_project. report saves the numbers as JSON. Calling
+    it more than once, e.g. once per host, has no effect.
+    """
+    if backends.installed():
+        return
+    backend = backends.install(backends.RecordingBackend())
+
+    def finish():
+        backend.print_plan()
+        if report:
+            backend.save(report)
+    atexit.register(finish)
+
+
+def on(selector=None, user=None):
+    """
+    Runs subsequent commands on every host matching the selector, e.g.
+    fab on:role:web update_project, fab on:tag:eu-* update_project or
+    fab "on:role:web;tag:canary" (see louis.inventory).
+    """
+    if not selector:
+        abort('on needs a selector such as role:web or tag:eu-*')
+    selected = inventory.select(selector)
+    env.hosts = inventory.choose(selected)
+    if len(selected) == 1:
+        env.hostname = selected[0].name
+    if user:
+        env.user = user
+
+
+def make_fxn(name):
     def fxn(user=None):
-        env.host_config = config
-        env.hosts = [ip]
+        env.hosts = inventory.choose([inventory.host(name)])
         env.hostname = name
         if user:
             env.user = user
     fxn.__doc__ = """Runs subsequent commands on %s. Takes optional user argument.""" % name
     return fxn
-for entry in conf.HOSTS:
-    ip, name = entry[:2]
-    if len(entry) > 2:
-        config = entry[2]
-    else:
-        config = {}
-    if not globals().has_key(name):
-        globals()[name] = make_fxn(name, ip, config)
+# one task per host, looked up in the inventory only when it's used.
+# Set louisconf.HOST_TASKS = False for big inventories and use on instead.
+if getattr(conf, 'HOST_TASKS', True):
+    for entry in conf.HOSTS:
+        name = entry[1]
+        if not globals().has_key(name):
+            globals()[name] = make_fxn(name)
 globals().pop('make_fxn')
+
+if getattr(conf, 'TRACE', False):
+    tracing.install()
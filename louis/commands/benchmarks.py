@@ -0,0 +1,100 @@
+import os
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fabric.api import abort
+from fabric.colors import green, red
+from louis import conf
+from louis import inventory
+from louis import workers
+
+benchmark_tasks = getattr(conf, 'BENCHMARK_TASKS',
+                          'init_server setup_project update_project')
+
+
+def _load(path):
+    try:
+        report_file = open(path)
+    except IOError:
+        return None
+    try:
+        return json.load(report_file)
+    finally:
+        report_file.close()
+
+
+def _measure(host, task):
+    """Plans the task in its own fab process and returns its numbers."""
+    handle, report_path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        job = workers.Job(task, workers.fab_command(
+            'on:%s' % host, 'plan:report=%s' % report_path, task))
+        job.run()
+        report = _load(report_path)
+    finally:
+        os.remove(report_path)
+    if job.failed or not report:
+        print(job.output)
+        abort('Planning %s failed.' % task)
+    return {
+        'round_trips': report['round_trips'],
+        'commands': report['commands'],
+        'bytes': report['bytes'],
+        'wall': job.duration,
+    }
+
+
+def _regressions(task, result, baseline, wall_tolerance):
+    found = []
+    # archives carry timestamps, so their compressed size wobbles a little
+    limits = {'round_trips': 0, 'commands': 0, 'bytes': 0.05}
+    for key, tolerance in limits.items():
+        if result[key] > baseline[key] * (1 + tolerance):
+            found.append('%s %s: %s -> %s' % (task, key, baseline[key], result[key]))
+    if result['wall'] > baseline['wall'] * (1 + wall_tolerance):
+        found.append('%s wall time: %.2fs -> %.2fs' %
+                     (task, baseline['wall'], result['wall']))
+    return found
+
+
+def benchmark(tasks=benchmark_tasks, host=None, update_baseline=False):
+    """
+    Plans each task (space separated, init_server, setup_project and
+    update_project by default) against the fake host of the plan task and
+    compares round trips, commands, bytes and wall time with the baseline
+    in louisconf.BENCHMARK_BASELINE (louis-benchmark.json). Aborts on any
+    regression; wall time may grow by louisconf.BENCHMARK_WALL_TOLERANCE
+    (50%). The baseline is written when missing or with update_baseline.
+    Set louisconf.PLAN_LATENCY to have round trips show in wall time.
+    """
+    host = host or inventory.hosts()[0].name
+    baseline_path = getattr(conf, 'BENCHMARK_BASELINE', 'louis-benchmark.json')
+    wall_tolerance = getattr(conf, 'BENCHMARK_WALL_TOLERANCE', 0.5)
+    baseline = _load(baseline_path) or {}
+    results = {}
+    regressions = []
+    print('%-16s %11s %9s %10s %8s' % ('task', 'round trips', 'commands', 'bytes', 'wall'))
+    for task in tasks.split():
+        results[task] = result = _measure(host, task)
+        print('%-16s %11d %9d %10d %7.2fs' % (task, result['round_trips'],
+              result['commands'], result['bytes'], result['wall']))
+        if task in baseline:
+            regressions.extend(_regressions(task, result, baseline[task],
+                                            wall_tolerance))
+    if str(update_baseline).lower() not in ('false', '0') or not baseline:
+        baseline.update(results)
+        baseline_file = open(baseline_path, 'w')
+        try:
+            json.dump(baseline, baseline_file, indent=1, sort_keys=True)
+        finally:
+            baseline_file.close()
+        print(green('Baseline saved in %s' % baseline_path))
+    if regressions:
+        for regression in regressions:
+            print(red(regression))
+        abort('Performance regressed against %s.' % baseline_path)
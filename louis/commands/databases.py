@@ -1,8 +1,60 @@
 from __future__ import with_statement
+import fnmatch
+import hashlib
+import subprocess
+import time
 
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
+from fabric.api import run, put, sudo, env, cd, local, prompt, settings, hide, abort
+from fabric.colors import green, red
 from fabric.contrib import files
 from louis import conf
+from louis import facts
+from louis import tuning
+import louis.batch
+import louis.sync
+from louis import streams
+from louis import workers
+from louis.commands.packages import _install_packages
+
+PGBOUNCER_PORT = 6432
+
+PGBOUNCER_TEMPLATE = """; Generated by louis.
+[databases]
+%(dbname)s = host=127.0.0.1 port=5432 dbname=%(dbname)s
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = %(port)d
+unix_socket_dir = /var/run/postgresql
+auth_type = md5
+auth_file = /etc/pgbouncer/userlist.txt
+pool_mode = %(pool_mode)s
+default_pool_size = %(pgbouncer_pool_size)d
+reserve_pool_size = %(pgbouncer_reserve_pool_size)d
+max_client_conn = %(pgbouncer_max_clients)d
+server_reset_query = DISCARD ALL
+server_idle_timeout = 600
+logfile = /var/log/postgresql/pgbouncer.log
+pidfile = /var/run/postgresql/pgbouncer.pid
+"""
+
+
+def _use_pgbouncer():
+    return getattr(conf, 'PGBOUNCER', True)
+
+
+def _database_context(username=conf.POSTGRES_USERNAME, dbname=conf.POSTGRES_DBNAME):
+    """
+    Where the project's Django settings should connect: db_host, db_port,
+    db_name and db_user. With pgbouncer (louisconf.PGBOUNCER, on by default)
+    that's the pooler, otherwise postgres itself.
+    """
+    return {
+        'db_host': '127.0.0.1',
+        'db_port': _use_pgbouncer() and PGBOUNCER_PORT or 5432,
+        'db_name': dbname,
+        'db_user': username,
+    }
 
 
 def create_postgres_user(username=conf.POSTGRES_USERNAME, password=conf.POSTGRES_PASSWORD):
@@ -42,6 +94,259 @@ def setup_postgres(project_name=None, password=None, dbname=None):
     # F it.  I'm bored.
     create_postgres_user()
     create_postgres_db()
+    if _use_pgbouncer():
+        setup_pgbouncer()
     # create_postgres_user(username=project_name, password=password)
     # create_postgres_db(owner=project_name, dbname=project_name)
 
+
+
+def setup_pgbouncer(username=conf.POSTGRES_USERNAME, password=conf.POSTGRES_PASSWORD,
+                    dbname=conf.POSTGRES_DBNAME, pool_mode=None):
+    """
+    Installs pgbouncer in front of the project's database, listening on
+    127.0.0.1:6432. Pools are sized from the host's mod_wsgi workers and
+    postgres' max_connections (see louis.tuning.pgbouncer_sizing), so
+    tune_postgres runs it again when that changes. The auth file holds the role
+    create_postgres_user creates. pool_mode defaults to
+    louisconf.PGBOUNCER_POOL_MODE, "session": Django sets the time zone once
+    per connection, which transaction pooling would lose.
+    """
+    _install_packages('pgbouncer')
+    context = tuning.pgbouncer_sizing(*_connection_limits())
+    context.update({
+        'dbname': dbname,
+        'port': PGBOUNCER_PORT,
+        'pool_mode': pool_mode or getattr(conf, 'PGBOUNCER_POOL_MODE', 'session'),
+    })
+    # the same md5 postgres stores for the role
+    digest = hashlib.md5(password + username).hexdigest()
+    sync = louis.sync.Sync()
+    sync.add(PGBOUNCER_TEMPLATE % context, '/etc/pgbouncer/pgbouncer.ini',
+             owner='postgres', mode='640')
+    sync.add('"%s" "md5%s"\n' % (username, digest), '/etc/pgbouncer/userlist.txt',
+             owner='postgres', mode='640')
+    sync.add('START=1\n', '/etc/default/pgbouncer')
+    changed = sync.run()
+    if changed == ['/etc/pgbouncer/userlist.txt']:
+        # the auth file is reread on reload; the listener isn't
+        sudo('/etc/init.d/pgbouncer reload')
+    elif changed:
+        sudo('/etc/init.d/pgbouncer restart')
+
+
+def _connection_limits():
+    """postgres' max_connections and superuser_reserved_connections."""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo('psql -At -c "SELECT setting FROM pg_settings WHERE name IN '
+                      '(\'max_connections\', \'superuser_reserved_connections\') '
+                      'ORDER BY name"', user='postgres')
+    limits = output.split()
+    if output.failed or len(limits) != 2:
+        # the defaults
+        return 100, 3
+    return int(limits[0]), int(limits[1])
+
+
+def _current_settings(path):
+    with settings(hide('running', 'stdout', 'stderr'), warn_only=True):
+        output = sudo('cat %s' % path)
+    current = {}
+    if output.failed:
+        return current
+    for line in output.splitlines():
+        if '=' in line and not line.startswith('#'):
+            name, value = line.split('=', 1)
+            current[name.strip()] = value.strip()
+    return current
+
+
+def tune_postgres(profile='web'):
+    """
+    Sizes postgres for the host's memory, cores and disk type and the given
+    workload profile: web (many short OLTP queries), mixed or analytics.
+    The settings go to an include file next to postgresql.conf, are checked
+    with postgres -C before they're kept, and postgres is only reloaded (or
+    restarted, for shared_buffers and friends) when a value changed.
+    """
+    versions = facts.get()['postgres_versions']
+    if not versions:
+        abort('Postgres is not installed, run install_postgres first.')
+    version = sorted(versions, key=tuning.postgres_version)[-1]
+    wanted = tuning.postgres_settings(profile, version)
+    problems = tuning.validate_postgres_settings(wanted)
+    if problems:
+        abort('Refusing to apply the %s profile: %s.' % (profile, '; '.join(problems)))
+
+    config_dir = '/etc/postgresql/%s/main' % version
+    include_path = '%s/louis-tuning.conf' % config_dir
+    content = tuning.render_postgres_settings(wanted, profile)
+    current = _current_settings(include_path)
+    rendered = dict((name, tuning.postgres_value(value))
+                    for name, value in wanted.items())
+    changed = [name for name in sorted(set(rendered) | set(current))
+               if rendered.get(name) != current.get(name)]
+    if not changed:
+        print('postgres %s already tuned for the %s profile.' % (version, profile))
+        return
+
+    batch = louis.batch.Batch()
+    batch.add('cp -p %s %s.bak 2>/dev/null || : > %s.bak' % (include_path, include_path, include_path))
+    batch.write(content, include_path)
+    batch.append("include '%s'" % include_path, '%s/postgresql.conf' % config_dir)
+    if tuning.postgres_version(version) < (9, 3):
+        # older versions allocate shared_buffers as System V shared memory
+        shmmax = int(tuning.megabytes(wanted['shared_buffers']) * 1.25 * 1024 * 1024)
+        batch.write('kernel.shmmax = %d\nkernel.shmall = %d\n' % (shmmax, shmmax // 4096),
+                    '/etc/sysctl.d/30-louis-postgres.conf')
+        batch.add('sysctl -p /etc/sysctl.d/30-louis-postgres.conf')
+    if tuning.postgres_version(version) >= (9, 2):
+        batch.add('sudo -u postgres /usr/lib/postgresql/%s/bin/postgres -C shared_buffers '
+                  '--config-file=%s/postgresql.conf >/dev/null || { mv %s.bak %s; exit 1; }' % (
+                      version, config_dir, include_path, include_path))
+    if [name for name in changed if name in tuning.POSTGRES_RESTART_SETTINGS]:
+        batch.add('pg_ctlcluster %s main restart' % version)
+    else:
+        batch.add('pg_ctlcluster %s main reload' % version)
+    batch.run()
+    for name in changed:
+        print('%s: %s -> %s' % (name, current.get(name, '(default)'),
+                                rendered.get(name, '(default)')))
+    if 'max_connections' in changed and _use_pgbouncer():
+        # its pools have to fit in the new limit
+        setup_pgbouncer()
+
+
+def _postgres(endpoint, command):
+    # a local endpoint uses the local user's own postgres access
+    if endpoint == 'local':
+        return command
+    return 'sudo -n -u postgres %s' % command
+
+
+def _export_snapshot(source, dbname):
+    """
+    Opens a transaction on the source and exports its snapshot, so that all
+    the dumps of a copy see the database at the same moment. Returns the
+    psql process holding the transaction, which has to stay open until the
+    dumps are done, and the snapshot's name for pg_dump --snapshot.
+    """
+    # psql only flushes its output line by line with stdbuf
+    psql = _postgres(source, '$(command -v stdbuf >/dev/null && echo stdbuf -oL) '
+                             'psql -qAt -v ON_ERROR_STOP=1 -d %s' % dbname)
+    holder = subprocess.Popen(streams.command(source, psql),
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    holder.stdin.write('BEGIN TRANSACTION ISOLATION LEVEL REPEATABLE READ;\n'
+                       'SELECT pg_export_snapshot();\n')
+    holder.stdin.flush()
+    snapshot = holder.stdout.readline().strip()
+    if not snapshot:
+        _release_snapshot(holder)
+        abort('Could not export a snapshot of %s on %s.' % (dbname, source))
+    return holder, snapshot
+
+
+def _release_snapshot(holder):
+    try:
+        holder.stdin.write('COMMIT;\n')
+        holder.stdin.close()
+    except IOError:
+        # psql is gone already
+        pass
+    holder.wait()
+
+
+def _tables(source, dbname):
+    """The source's tables, biggest first."""
+    query = ("SELECT quote_ident(schemaname) || '.' || quote_ident(tablename) "
+             "FROM pg_tables WHERE schemaname NOT IN ('pg_catalog', 'information_schema') "
+             "ORDER BY pg_total_relation_size(quote_ident(schemaname) || '.' || "
+             "quote_ident(tablename)) DESC")
+    output = streams.output(source, _postgres(source, 'psql -At -d %s -c %s' % (
+        dbname, louis.batch.quote(query))))
+    return [t for t in output.splitlines() if t.strip()]
+
+
+def _select_tables(tables, include, exclude):
+    def matches(table, patterns):
+        bare = table.split('.', 1)[-1].strip('"')
+        return [p for p in patterns if fnmatch.fnmatch(table, p) or fnmatch.fnmatch(bare, p)]
+    include = [p for p in (include or '').split(';') if p]
+    exclude = [p for p in (exclude or '').split(';') if p]
+    return [t for t in tables if (not include or matches(t, include)) and
+            not matches(t, exclude)]
+
+
+def _megabytes_per_second(transferred, duration):
+    return transferred / 1048576.0 / max(duration, 0.001)
+
+
+def clone_postgres_db(source, target, dbname=conf.POSTGRES_DBNAME, target_dbname=None,
+                      owner=conf.POSTGRES_USERNAME, include=None, exclude=None,
+                      jobs=4, replace=False):
+    """
+    Copies a database from source to target, host names from louisconf.HOSTS
+    or "local", without intermediate files. e.g.
+    fab clone_postgres_db:db1,staging1,exclude=django_session;*_log
+
+    pg_dump's output is gzipped on the source and streamed through this
+    machine into psql on the target: the schema first, then the tables'
+    data, jobs tables at a time, then indexes and constraints, so they're
+    built once on the loaded tables. Every dump reads the same snapshot, so
+    a live database is copied as it was at one moment. include and exclude are semicolon
+    separated table patterns; tables without their data are still created.
+    The target database is created for owner, and must be empty unless
+    replace is given. Needs postgres 9.2 on the source.
+    """
+    target_dbname = target_dbname or dbname
+    start = time.time()
+    tables = _tables(source, dbname)
+    selected = _select_tables(tables, include, exclude)
+    print(green('Copying %d of %d tables from %s to %s' % (
+        len(selected), len(tables), source, target)))
+
+    existing = streams.output(target, _postgres(target, 'psql -At -d postgres -c %s' % (
+        louis.batch.quote("SELECT 1 FROM pg_database WHERE datname = '%s'" % target_dbname))))
+    if existing.strip():
+        if str(replace).lower() in ('false', '0'):
+            abort('%s already exists on %s, pass replace=True to drop it.' % (target_dbname, target))
+        streams.output(target, _postgres(target, 'dropdb %s' % target_dbname))
+    streams.output(target, _postgres(target, 'createdb --encoding UTF8 -T template0 -O %s %s' % (
+        owner, target_dbname)))
+
+    restore = _postgres(target, 'psql -q -v ON_ERROR_STOP=1 -d %s' % target_dbname)
+    holder, snapshot = _export_snapshot(source, dbname)
+    dump = 'pg_dump --snapshot=%s' % snapshot
+
+    def section(name):
+        return streams.Stream(name, source, '%s | gzip -1' % _postgres(
+            source, '%s --section=%s %s' % (dump, name, dbname)),
+            target, 'gunzip | %s' % restore)
+
+    def report(stream):
+        if stream.failed:
+            print(red('%s failed: %s' % (stream.name, stream.error)))
+        else:
+            print('%-40s %8.1f MB %6.1fs %6.1f MB/s' % (
+                stream.name[:40], stream.transferred / 1048576.0, stream.duration,
+                _megabytes_per_second(stream.transferred, stream.duration)))
+
+    try:
+        done = workers.run_jobs([section('pre-data')], 1, report)
+        if not done[0].failed:
+            data = [streams.Stream(table, source, '%s | gzip -1' % _postgres(
+                        source, '%s --data-only -t %s %s' % (dump, louis.batch.quote(table), dbname)),
+                        target, 'gunzip | %s' % restore)
+                    for table in selected]
+            done.extend(workers.run_jobs(data, jobs, report))
+        if not [s for s in done if s.failed]:
+            done.extend(workers.run_jobs([section('post-data')], 1, report))
+    finally:
+        _release_snapshot(holder)
+    duration = time.time() - start
+    transferred = sum(s.transferred for s in done)
+    failed = [s.name for s in done if s.failed]
+    print('%.1f MB compressed in %.1fs, %.1f MB/s' % (
+        transferred / 1048576.0, duration, _megabytes_per_second(transferred, duration)))
+    if failed:
+        abort('Copying %s failed: %s' % (dbname, ', '.join(failed)))
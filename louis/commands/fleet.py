@@ -0,0 +1,186 @@
+import os
+import time
+import urllib2
+
+from fabric.api import abort
+from fabric.colors import green, red, yellow
+from louis import backends
+from louis import conf
+from louis import inventory
+from louis import trace as tracing
+from louis import workers
+from louis.commands.projects import _is_schema_host
+
+
+def _host_names(targets=None):
+    """
+    Returns the names of the hosts to act on. targets is a semicolon
+    separated list of host names or selectors such as role:web or tag:eu-*
+    (see louis.inventory) and defaults to every host.
+    """
+    if not targets:
+        return [h.name for h in inventory.hosts()]
+    return [h.name for h in inventory.select(targets)]
+
+
+def _pool_size(pool_size=None):
+    return int(pool_size or getattr(conf, 'PARALLEL_POOL_SIZE', 5))
+
+
+def _print_summary(jobs):
+    print(green('Summary:'))
+    for job in jobs:
+        if job.failed:
+            print(red('  %-20s FAILED (%.1fs)' % (job.name, job.duration)))
+        else:
+            print(green('  %-20s ok (%.1fs)' % (job.name, job.duration)))
+    failed = [job for job in jobs if job.failed]
+    print('%d ok, %d failed' % (len(jobs) - len(failed), len(failed)))
+
+
+def _log_dir():
+    return os.path.join(getattr(conf, 'PARALLEL_LOG_DIR', 'louis-logs'),
+                        time.strftime('%Y%m%d-%H%M%S'))
+
+
+def _run_on_hosts(names, tasks, pool_size=None, user=None, log_dir=None):
+    """
+    Runs the fab tasks on every named host through a bounded pool and
+    returns the finished jobs. Output of every host is kept in a log file.
+    """
+    jobs = []
+    if tracing.enabled():
+        # every host traces its own run
+        tasks = ['trace'] + list(tasks)
+    if backends.installed():
+        # a plan has every host plan its run instead of deploying
+        tasks = ['plan'] + list(tasks)
+    for name in names:
+        selector = 'on:%s' % name
+        if user:
+            selector = '%s,user=%s' % (selector, user)
+        jobs.append(workers.Job(name, workers.fab_command(selector, *tasks)))
+
+    def report(job):
+        if job.failed:
+            print(red('[%s] failed after %.1fs' % (job.name, job.duration)))
+        else:
+            print(green('[%s] done in %.1fs' % (job.name, job.duration)))
+
+    workers.run_jobs(jobs, _pool_size(pool_size), callback=report)
+    log_dir = log_dir or _log_dir()
+    workers.write_logs(jobs, log_dir)
+    print('Output of every host was saved in %s' % log_dir)
+    return jobs
+
+
+def parallel(task, targets=None, pool_size=None, user=None):
+    """
+    Runs a task on several hosts at the same time, e.g.
+    fab parallel:update_project,targets="web1;web2",pool_size=10
+
+    task may hold several space separated tasks. targets defaults to every
+    host in louisconf.HOSTS and pool_size to louisconf.PARALLEL_POOL_SIZE (5).
+    """
+    names = _host_names(targets)
+    print(green('Running "%s" on %d hosts, %d at a time' %
+                (task, len(names), min(_pool_size(pool_size), len(names)))))
+    jobs = _run_on_hosts(names, task.split(), pool_size, user)
+    _print_summary(jobs)
+    if [job for job in jobs if job.failed]:
+        abort('"%s" failed on some hosts.' % task)
+
+
+def _batches(names, batch_size):
+    """
+    Splits names in batches. batch_size is either a number of hosts or a
+    percentage of the fleet such as "25%".
+    """
+    batch_size = str(batch_size)
+    if batch_size.endswith('%'):
+        size = len(names) * float(batch_size[:-1]) / 100
+    else:
+        size = float(batch_size)
+    size = max(1, int(size))
+    return [names[i:i + size] for i in range(0, len(names), size)]
+
+
+def _check_health(name, path=None, attempts=None, delay=None):
+    """
+    Requests the health check path on the host until it answers with a 200
+    or the attempts run out. The request carries the project's server name
+    so that it reaches the project's virtual host. It goes to port 80, or
+    the host_config's "http-port"; a port in the host's address is ssh's.
+    """
+    path = path or getattr(conf, 'HEALTH_CHECK_PATH', '/')
+    attempts = int(attempts or getattr(conf, 'HEALTH_CHECK_ATTEMPTS', 5))
+    delay = float(delay or getattr(conf, 'HEALTH_CHECK_DELAY', 2))
+    host = inventory.host(name)
+    url = 'http://%s:%d%s' % (host.address.split(':')[0],
+                              int(host.config.get('http-port', 80)), path)
+    for attempt in range(attempts):
+        request = urllib2.Request(url,
+                                  headers={'Host': conf.APACHE_SERVER_NAME})
+        try:
+            if urllib2.urlopen(request, timeout=10).getcode() == 200:
+                return True
+        except Exception, e:
+            print(red('[%s] health check failed: %s' % (name, e)))
+        time.sleep(delay)
+    return False
+
+
+def rolling_update(batch_size=None, targets=None, max_failures=None,
+                   health_path=None, user=None):
+    """
+    Updates the project on the fleet a batch at a time, e.g.
+    fab rolling_update:batch_size=25%,max_failures=1
+
+    Database migrations only run on the schema host (see
+    projects._is_schema_host), which is updated first. Every batch has to pass
+    the HTTP health check (louisconf.HEALTH_CHECK_PATH, skipped in a plan)
+    before the next one starts, and the deploy stops as soon as more than
+    max_failures hosts failed. batch_size defaults to louisconf.ROLLING_BATCH_SIZE (1) and
+    max_failures to louisconf.ROLLING_MAX_FAILURES (0).
+    """
+    names = _host_names(targets)
+    batch_size = batch_size or getattr(conf, 'ROLLING_BATCH_SIZE', 1)
+    if max_failures is None:
+        max_failures = getattr(conf, 'ROLLING_MAX_FAILURES', 0)
+    max_failures = int(max_failures)
+    log_dir = _log_dir()
+    # migrate once, before any host serves the new code
+    schema_hosts = [n for n in names if _is_schema_host(n)]
+    if schema_hosts:
+        names.remove(schema_hosts[0])
+        names.insert(0, schema_hosts[0])
+    else:
+        print(yellow('None of the hosts is a schema host, no migrations will run.'))
+    batches = [[names[0]]] + _batches(names[1:], batch_size)
+    failed = []
+    done = []
+    for number, batch in enumerate([b for b in batches if b]):
+        print(green('Batch %d: %s' % (number + 1, ', '.join(batch))))
+        if number == 0:
+            tasks = ['update_project']
+        else:
+            tasks = ['update_project:migrate=False']
+        jobs = _run_on_hosts(batch, tasks, len(batch), user,
+                             os.path.join(log_dir, 'batch-%d' % (number + 1)))
+        for job in jobs:
+            if job.failed or not (backends.installed() or
+                                  _check_health(job.name, health_path)):
+                failed.append(job.name)
+            else:
+                done.append(job.name)
+        if number == 0 and failed:
+            abort('Update failed on %s, the first host. Nothing else was '
+                  'touched.' % failed[0])
+        if len(failed) > max_failures:
+            abort('%d hosts failed (%s), more than the allowed %d. Stopping '
+                  'with %d hosts updated and %d untouched.' %
+                  (len(failed), ', '.join(failed), max_failures, len(done),
+                   len(names) - len(done) - len(failed)))
+    print(green('Updated %d hosts.' % len(done)))
+    if failed:
+        print(red('Failed hosts: %s' % ', '.join(failed)))
@@ -0,0 +1,52 @@
+from fabric.api import env, abort
+from louis import backends
+from louis import conf
+from louis import graph
+from louis import inventory
+from louis import trace as tracing
+from louis import workers
+from louis.commands.packages import _wants_memcached
+
+
+def schedule(name='init_server', pool_size=None, apache=True, postgres=True,
+             memcached=None):
+    """
+    Runs init_server or setup_project on the current host as a graph of
+    steps (see louis.graph): steps that don't depend on each other run at
+    the same time, up to pool_size (louisconf.SCHEDULE_POOL_SIZE, 4), and
+    steps sharing a lock such as dpkg's never do. Prints when each step ran
+    and the critical path. e.g. fab web1 schedule:init_server,postgres=False
+
+    setup_project doesn't stop to show the project user's public key before
+    cloning, so the key has to be authorised on the repository already.
+    """
+    if name not in graph.GRAPHS:
+        abort('Unknown graph %s, use one of %s' % (name, ', '.join(sorted(graph.GRAPHS))))
+    steps = graph.GRAPHS[name]
+    if str(apache).lower() in ('false', '0'):
+        steps = graph.without(steps, ['install_apache'])
+    if str(postgres).lower() in ('false', '0'):
+        steps = graph.without(steps, ['install_postgres'])
+    if not _wants_memcached(memcached):
+        steps = graph.without(steps, ['install_memcached'])
+    selector = 'on:%s' % inventory.hostname()
+    if env.user:
+        selector = '%s,user=%s' % (selector, env.user)
+
+    def command(task):
+        tasks = [task]
+        if tracing.enabled():
+            tasks.insert(0, 'trace')
+        if backends.installed():
+            # a plan has every step plan its run instead of running it
+            tasks.insert(0, 'plan')
+        return workers.fab_command(selector, *tasks)
+
+    jobs = graph.run(steps, command,
+                     pool_size or getattr(conf, 'SCHEDULE_POOL_SIZE', 4))
+    log_dir = getattr(conf, 'PARALLEL_LOG_DIR', 'louis-logs')
+    workers.write_logs(jobs.values(), log_dir)
+    print('Output of every step was saved in %s' % log_dir)
+    failed = [n for n, job in jobs.items() if job.failed]
+    if failed or len(jobs) < len(steps):
+        abort('%s did not complete: %s failed.' % (name, ', '.join(failed)))
@@ -1,15 +1,98 @@
 from __future__ import with_statement
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
-from fabric.colors import green
+import time
+
+from fabric.api import run, put, sudo, env, cd, local, prompt, settings, hide
+from fabric.colors import green, red
 from fabric.contrib import files
 from louis import conf
+from louis import facts
+from louis import inventory
+from louis import state
+from louis import tuning
+import louis.batch
+import louis.sync
+
+APACHE_PACKAGES = ('apache2', 'apache2-utils', 'libapache2-mod-wsgi', )
+POSTGRES_PACKAGES = ('postgresql', 'python-egenix-mxdatetime')
+
+MEMCACHED_PORT = 11211
+
+MEMCACHED_TEMPLATE = """# Generated by louis for %(cpus)d cpus and %(memory_mb)d MB of memory.
+-d
+logfile /var/log/memcached.log
+-m %(memcached_memory_mb)d
+-p %(port)d
+-u memcache
+-l %(listen)s
+-c %(memcached_connections)d
+-t %(memcached_threads)d
+# no UDP: it isn't used and answers spoofed requests with large replies
+-U 0
+"""
+
+# host_string -> {package name: installed version or None}, seeded from the
+# host's facts and kept up to date as louis installs packages
+_installed = {}
+
+
+def _split_spec(spec):
+    """'name=version' -> ('name', 'version'), 'name' -> ('name', None)"""
+    name, sep, version = spec.partition('=')
+    return name, version or None
+
+
+def plan_packages(*packages):
+    """
+    Returns the packages that still need to be installed. What's installed
+    comes from the host's facts, so dpkg is asked at most once per run.
+    """
+    if env.host_string not in _installed:
+        _installed[env.host_string] = dict(facts.get()['packages'])
+    installed = _installed[env.host_string]
+    missing = []
+    for spec in packages:
+        name, version = _split_spec(spec)
+        current = installed.get(name)
+        if current is None or (version and current != version):
+            missing.append(spec)
+    return missing
+
 
 def _install_packages(*packages):
-    packages = " ".join(packages)
+    missing = plan_packages(*packages)
+    skipped = [p for p in packages if p not in missing]
+    if skipped:
+        print(green('Already installed: %s' % " ".join(skipped)))
+    if not missing:
+        return
+    packages = " ".join(missing)
     print(green('Installing %s' % packages))
     sudo('DEBIAN_FRONTEND=noninteractive apt-get -y -q=2 '
          'install %s >/dev/null' % packages, shell=False)
+    installed = _installed[env.host_string]
+    for name, version in [_split_spec(p) for p in missing]:
+        # the exact version doesn't matter anymore, only that it's there
+        installed[name] = version or 'installed'
+    facts.invalidate()
+
+
+def _server_packages(apache=True, postgres=True):
+    packages = list(conf.BASIC_PACKAGES)
+    if apache:
+        packages.extend(APACHE_PACKAGES)
+    if postgres:
+        packages.extend(POSTGRES_PACKAGES)
+    return packages
+
 
+def install_server_packages(apache=True, postgres=True):
+    """
+    Installs every package init_server needs in a single apt transaction.
+    The later install_* steps then find them installed and skip apt.
+    """
+    _install_packages(*_server_packages(apache, postgres))
+
+@state.step(lambda: time.strftime("%Y-%m-%d"))
 def update():
     """
     Updates package list and installs the ones that need updates.
@@ -24,6 +107,7 @@ def update():
           '-y -q=2 > /dev/null')
 
 
+@state.step(lambda: [open(path).read() for path in conf.DEBCONF_SEEDS])
 def install_debconf_seeds():
     _install_packages("debconf-utils")
     for seed_file in conf.DEBCONF_SEEDS:
@@ -33,6 +117,7 @@ def install_debconf_seeds():
         sudo('debconf-set-selections /tmp/%s' % seed_filename)
 
 
+@state.step(lambda: conf.BASIC_PACKAGES)
 def install_basic_packages():
     """
     Installs basic packages as specified in louisconf.BASIC_PACKAGES
@@ -40,6 +125,7 @@ def install_basic_packages():
     _install_packages(*conf.BASIC_PACKAGES)
 
 
+@state.step(lambda: sorted(v['email'] for v in conf.SYSADMINS.values()))
 def config_apticron():
     """
     Adds sysadmin emails to the apticron config.
@@ -48,6 +134,7 @@ def config_apticron():
     files.sed('/etc/apticron/apticron.conf', '"root"', '"%s"' % emails, 
               limit="EMAIL=", use_sudo=True)
 
+@state.step(lambda: getattr(conf, "EXIM_CONFIG_TYPE", None))
 def config_exim():
     """Set exim configuration type if defined by the user."""
     if hasattr(conf, "EXIM_CONFIG_TYPE"):
@@ -56,21 +143,24 @@ def config_exim():
               limit="dc_eximconfig_configtype=", use_sudo=True)
         sudo("/etc/init.d/exim4 restart")
 
+@state.step()
 def config_sshd():
     """Disables password-based and root logins. Make sure that you have some
     users created with ssh keys before running this."""
     sshd_config = '/etc/ssh/sshd_config'
-    files.sed(sshd_config, 'yes', 'no', limit='PermitRootLogin', use_sudo=True)
-    files.sed(sshd_config, '#PasswordAuthentication yes', 'PasswordAuthentication no', use_sudo=True)
-    sudo('/etc/init.d/ssh restart')
+    batch = louis.batch.Batch()
+    batch.sed(sshd_config, 'yes', 'no', limit='PermitRootLogin')
+    batch.sed(sshd_config, '#PasswordAuthentication yes', 'PasswordAuthentication no')
+    batch.add('/etc/init.d/ssh restart')
+    batch.run()
 
 
+@state.step()
 def install_apache():
     """
     Installs apache2, mod-wsgi, and mod-ssl.
     """
-    pkgs = ('apache2', 'apache2-utils', 'libapache2-mod-wsgi', )
-    _install_packages(*pkgs)
+    _install_packages(*APACHE_PACKAGES)
     sudo('virtualenv --no-site-packages /var/www/virtualenv')
     sudo('echo "WSGIPythonHome /var/www/virtualenv" >> /etc/apache2/conf.d/wsgi-virtualenv')
     sudo('a2enmod ssl')
@@ -79,16 +169,102 @@ def install_apache():
     sudo('/etc/init.d/apache2 reload')
 
 
+@state.step()
 def install_postgres():
     """
     Installs postgres and python mxdatetime.
     """
-    pkgs = ('postgresql', 'python-egenix-mxdatetime')
-    _install_packages(*pkgs)
+    _install_packages(*POSTGRES_PACKAGES)
     sudo('DEBIAN_FRONTEND=noninteractive apt-get -y -q=2 '
          'build-dep psycopg2 >/dev/null')
 
 
+def _memcached_listen():
+    """
+    Hosts with the cache role (louisconf.MEMCACHED_ROLE) serve the other
+    hosts on their address; everywhere else memcached only listens locally.
+    """
+    if getattr(conf, 'MEMCACHED_ROLE', 'cache') in inventory.roles():
+        return inventory.current().address.split(':')[0]
+    return '127.0.0.1'
+
+
+def _cache_context():
+    """
+    The memcached servers the project should use: cache_location, as
+    Django's memcached backends take it ("host:port;host:port"), and
+    cache_endpoints, a list of the same. These are the hosts with the cache
+    role, or this host's own memcached when louisconf.MEMCACHED is set,
+    or nothing.
+    """
+    servers = inventory.with_role(getattr(conf, 'MEMCACHED_ROLE', 'cache'))
+    endpoints = ['%s:%d' % (h.address.split(':')[0], MEMCACHED_PORT) for h in servers]
+    if not endpoints and getattr(conf, 'MEMCACHED', False):
+        endpoints = ['127.0.0.1:%d' % MEMCACHED_PORT]
+    return {
+        'cache_endpoints': endpoints,
+        'cache_location': ';'.join(endpoints),
+    }
+
+
+def _wants_memcached(memcached=None):
+    if getattr(conf, 'MEMCACHED_ROLE', 'cache') in inventory.roles():
+        return True
+    if memcached is None:
+        return getattr(conf, 'MEMCACHED', False)
+    return str(memcached).lower() not in ('false', '0')
+
+
+def install_memcached():
+    """
+    Installs memcached with memory, threads and connections sized for the
+    host (see louis.tuning.memcached_sizing), listening on 127.0.0.1, or on
+    the host's address for hosts with the cache role. It's only restarted
+    when its configuration changed.
+
+    UDP is turned off, but memcached has no authentication: on cache hosts
+    whose address is reachable from outside, firewall TCP port 11211 so
+    only the app servers get through. louis doesn't manage the firewall.
+    """
+    _install_packages('memcached')
+    context = tuning.memcached_sizing()
+    host_facts = facts.get()
+    context.update({
+        'cpus': host_facts['cpus'],
+        'memory_mb': host_facts['memory_mb'],
+        'port': MEMCACHED_PORT,
+        'listen': _memcached_listen(),
+    })
+    sync = louis.sync.Sync()
+    sync.add(MEMCACHED_TEMPLATE % context, '/etc/memcached.conf')
+    if sync.run():
+        sudo('/etc/init.d/memcached restart')
+
+
+def memcached_stats():
+    """
+    Prints the host's memcached hit ratio, evictions and memory use.
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run("exec 3<>/dev/tcp/%s/%d && printf 'stats\\r\\nquit\\r\\n' >&3 && cat <&3"
+                     % (_memcached_listen(), MEMCACHED_PORT))
+    if output.failed:
+        print(red('[%s] memcached is not answering' % env.host_string))
+        return
+    stats = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'STAT':
+            stats[fields[1]] = fields[2]
+    hits, misses = int(stats.get('get_hits', 0)), int(stats.get('get_misses', 0))
+    ratio = hits * 100.0 / max(1, hits + misses)
+    print('[%s] hit ratio %.1f%% (%d hits, %d misses), %s evictions, '
+          '%s items, %.1f of %.1f MB' % (
+              env.host_string, ratio, hits, misses, stats.get('evictions', '?'),
+              stats.get('curr_items', '?'), int(stats.get('bytes', 0)) / 1048576.0,
+              int(stats.get('limit_maxbytes', 0)) / 1048576.0))
+
+
 def patch_virtualenv(user, package_path, virtualenv_path='env'):
     """
     Symlinks package_path in virtual env's site-packages.
@@ -97,6 +273,11 @@ def patch_virtualenv(user, package_path, virtualenv_path='env'):
         target = '/home/%s/%s/lib/python2.6/site-packages/' % (user, virtualenv_path)
         run('ln -s %s %s' % (package_path, target))
 
-def set_timezone(timezone):
-    sudo('echo "%s" > /etc/timezone' % timezone)
-    sudo("dpkg-reconfigure --frontend noninteractive tzdata")
+def set_timezone(timezone, batch=None):
+    own_batch = batch is None
+    if own_batch:
+        batch = louis.batch.Batch()
+    batch.add('echo "%s" > /etc/timezone' % timezone)
+    batch.add("dpkg-reconfigure --frontend noninteractive tzdata")
+    if own_batch:
+        batch.run()
@@ -1,15 +1,26 @@
 from __future__ import with_statement
+import fnmatch
 import os
 
 from fabric.operations import prompt
 from fabric.contrib.console import confirm
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
+from fabric.api import run, put, sudo, env, cd, local, prompt, settings, hide
 from fabric.contrib import files
 from fabric.colors import green, red
 from louis import conf
 import louis.commands
-from louis.commands.users import add_ssh_keys
-from louis.commands.databases import setup_postgres
+import louis.assets
+import louis.batch
+import louis.sync
+from louis import accounts
+from louis import facts
+from louis import gitcache
+from louis import inventory
+from louis import tuning
+from louis import warmup
+from louis import wheelhouse
+from louis.commands.databases import setup_postgres, _database_context
+from louis.commands.packages import _cache_context
 
 
 branch = conf.GIT_BRANCH
@@ -34,24 +45,58 @@ def _get_django_settings():
             or getattr(conf, "DJANGO_SETTINGS_MODULE",
 			           "production-settings"))
 
+def _template_context(project_name=project_name,
+                      project_username=project_username,
+                      django_settings=None,
+                      apache_server_name=apache_server_name,
+                      apache_server_alias=apache_server_alias,
+                      server_admin=server_admin,
+                      env_path=env_path,
+                      branch=branch):
+    """
+    The context every project template (*.apache2, *.wsgi, scripts, crontab
+    and logrotate) is rendered with. Besides the project settings it has the
+    host's sizing from louis.tuning: wsgi_processes, wsgi_threads and the
+    mpm_* limits, e.g. WSGIDaemonProcess ... processes=%(wsgi_processes)s,
+    and the database to connect to from louis.commands.databases: db_host,
+    db_port (pgbouncer's when it's in use), db_name and db_user, and the
+    memcached servers, cache_location (e.g. for CACHES' LOCATION) and
+    cache_endpoints, from louis.commands.packages.
+    """
+    context = tuning.wsgi_sizing()
+    context.update(_database_context())
+    context.update(_cache_context())
+    context.update({
+        'hostname': inventory.hostname(),
+        'project_name': project_name,
+        'project_username': project_username,
+        'server_name': apache_server_name,
+        'server_alias': apache_server_alias,
+        'django_settings': django_settings or _get_django_settings(),
+        'env_path': env_path,
+        'branch': branch,
+        'server_admin': server_admin,
+    })
+    return context
+
 def setup_project_user(project_username=project_username):
     """
-    Create a crippled user to hold project-specific files.
+    Create a crippled user to hold project-specific files. Every sysadmin's
+    keys are in its authorized_keys; running it again adds keys that were
+    added to louisconf.SYSADMINS since.
     """
-    with settings(warn_only=True):
-        check_user = sudo('grep -e "%s:" /etc/passwd' % project_username)
-    if not check_user.failed:
-        return
-    sudo('adduser --gecos %s --disabled-password %s' % ((project_username,)*2))
-    sudo('usermod -a -G www-data %s' % project_username)
-    for u, s in conf.SYSADMINS.items():
-        add_ssh_keys(target_username=project_username, ssh_key_path=s['ssh_key_path'])
-    with settings(user=project_username):
-        run('mkdir -p .ssh')
-        run('ssh-keygen -t rsa -f .ssh/id_rsa -N ""')
+    wanted = {project_username: accounts.account(accounts.sysadmin_keys(),
+                                                 groups=['www-data'])}
+    batch = louis.batch.Batch()
+    accounts.sync(wanted, batch=batch)
+    with batch.unless('test -f /home/%s/.ssh/id_rsa' % project_username):
+        batch.add('ssh-keygen -q -t rsa -f .ssh/id_rsa -N ""', user=project_username)
         # so that we don't get a yes/no prompt when checking out repos via ssh
-        files.append(['Host *', 'StrictHostKeyChecking no'], '.ssh/config')
-        run('mkdir log')
+        batch.append(['Host *', 'StrictHostKeyChecking no'], '.ssh/config',
+                     user=project_username)
+        batch.add('mkdir -p log', user=project_username)
+    if accounts.report(batch.run(quiet=True)[0], wanted):
+        facts.invalidate()
 
 
 def setup_project_virtualenv(project_username=project_username,
@@ -74,7 +119,8 @@ def setup_project_virtualenv(project_username=project_username,
 
 def install_project_requirements(project_username=project_username,
                                  requirements_path=requirements_path,
-                                 env_path=env_path):
+                                 env_path=env_path,
+                                 force=False):
     """
     Installs a requirements file via pip.
 
@@ -83,12 +129,60 @@ def install_project_requirements(project_username=project_username,
     directory and it defaults to project_username/deploy/requirements.txt
     The env path should also be relative to the project user's home directory and
     defaults to env.
+
+    Nothing is installed when the virtualenv was last updated from the same
+    requirements file, unless force is given. With louisconf.WHEELHOUSE set,
+    wheels are built once (see louis.wheelhouse) and installed without
+    touching the package index.
     """
     if extra_project_requirements:
         extra_project_requirements()
+    stamp_path = '%s/.louis-requirements-sha1' % env_path
     with settings(user=project_username):
         with cd('/home/%s' % project_username):
-            run('%s/bin/pip install --use-mirrors -r %s' % (env_path, requirements_path))
+            with settings(hide('running', 'stdout'), warn_only=True):
+                hashes = run('echo "$(sha1sum < %s | cut -c1-40):$(cat %s 2>/dev/null)"'
+                             % (requirements_path, stamp_path))
+            remote_hash, sep, installed_hash = hashes.strip().partition(':')
+            if not force and remote_hash and remote_hash == installed_hash:
+                print(green('Requirements unchanged since the last install, skipping pip.'))
+                return
+            if _wheelhouse_matches(remote_hash):
+                _install_from_wheelhouse(requirements_path, env_path)
+            else:
+                run('%s/bin/pip install --use-mirrors -r %s' % (env_path, requirements_path))
+            if remote_hash:
+                run('echo %s > %s' % (remote_hash, stamp_path))
+
+
+def _wheelhouse_matches(remote_hash):
+    """
+    Tells whether the wheelhouse can be used: it has to be turned on and the
+    local requirements file has to be the one the host is deploying.
+    """
+    if not getattr(conf, 'WHEELHOUSE', False):
+        return False
+    local_path = getattr(conf, 'LOCAL_REQUIREMENTS_PATH', 'deploy/requirements.txt')
+    if not os.path.exists(local_path):
+        print(red('%s not found, not using the wheelhouse.' % local_path))
+        return False
+    if wheelhouse.requirements_hash(local_path) != remote_hash:
+        print(red('Local requirements differ from the deployed ones, not using the wheelhouse.'))
+        return False
+    return True
+
+
+def _install_from_wheelhouse(requirements_path, env_path):
+    local_path = getattr(conf, 'LOCAL_REQUIREMENTS_PATH', 'deploy/requirements.txt')
+    digest = wheelhouse.requirements_hash(local_path)
+    wheel_dir = '.louis-wheelhouse/%s' % digest
+    if not files.exists(wheel_dir):
+        tarball = wheelhouse.build(local_path)
+        put(tarball, '/tmp/%s.tar.gz' % digest)
+        run('mkdir -p %s && tar xzf /tmp/%s.tar.gz -C %s' % (wheel_dir, digest, wheel_dir))
+        run('rm -f /tmp/%s.tar.gz' % digest)
+    run('%s/bin/pip install --no-index --find-links=%s -r %s' % (env_path, wheel_dir, requirements_path))
+
 
 def setup_project_code(project_name=project_name,
                        project_username=project_username,
@@ -99,31 +193,28 @@ def setup_project_code(project_name=project_name,
     be relative to project_username's home directory. target directory defaults
     to the value of project_username ie you'll end up with the code in
     /home/project/project/
+
+    See louis.gitcache for the shared mirror and shallow clone settings.
     """
     with cd('/home/%s' % project_username):
         with settings(user=project_username):
-            if files.exists(project_name):
+            if facts.exists('/home/%s/%s' % (project_username, project_name)):
                 print(red('Destination path already exists ie the repo has been cloned already.'))
                 if confirm(red('Delete existing repo and re-clone?')):
                    run('rm -rf %s' % project_name)
                 else:
                     return
-            run('git clone %s %s' % (git_url, project_name))
-            with cd('%s' % project_name):
-                #run('git submodule update --init') # --recursive')
-                run('git submodule init')
-                run('git submodule update')
-                # checkout and update all remote branches, so that the deployment 
-                # can be any one of them
-                branches = run('git branch -r').split('\n')
-                for b in branches:
-                    if 'master' in b or 'HEAD' in b:
-                        # all remote branches except HEAD and master since those
-                        # by default
-                        continue
-                    r, sep, branch_name = b.strip().rpartition('/')
-                    run('git branch %s --track origin/%s' % (branch_name, branch_name))
-                run('git checkout %s' % branch)
+            # clone, submodules and branch tracking in one round trip
+            commands = [gitcache.clone_command(project_name, git_url, branch),
+                        'cd %s' % project_name,
+                        gitcache.submodules_command(),
+                        # all remote branches, so that the deployment can be
+                        # any one of them
+                        gitcache.track_branches_command(branch)]
+            if gitcache.use_cache():
+                commands.insert(0, gitcache.mirror_command(project_name, git_url))
+            run(' && '.join(commands))
+    facts.invalidate()
 
 
 def setup_project_apache(project_name=project_name,
@@ -139,13 +230,17 @@ def setup_project_apache(project_name=project_name,
     Configure apache-related settings for the project.
     
     This will render every  *.apache2 file in the current local directory as a
-    template with project_name, project_username, branch, server_name and
-    server_alias as context. It'll put the rendered template in apache
-    sites-available.
+    template with project_name, project_username, branch, server_name,
+    server_alias and the host's wsgi_processes and wsgi_threads as context
+    (see _template_context). It'll put the rendered template in apache
+    sites-available, next to MPM worker limits sized for the host.
     
     It will also render any *.wsgi file with the same context. It will put the
     rendered file in the project user's home directory.
 
+    Only files whose rendered content differs from the installed ones are
+    uploaded, and apache is only checked and reloaded when something changed.
+
     media_directory should be relative to the project user's home directory. It
     defaults to project_username/media ie you'd end up with
     /home/project/project/media/
@@ -155,36 +250,44 @@ def setup_project_apache(project_name=project_name,
         # permissions for media/
         sudo('chgrp www-data -R %s' % media_directory)
         sudo('chmod g+w %s' % media_directory)
-    context = {
-        'project_name': project_name,
-        'project_username': project_username,
-        'server_name': apache_server_name,
-        'server_alias': apache_server_alias,
-        'django_settings': django_settings,
-        'env_path': env_path,
-        'branch': branch,
-        'server_admin': server_admin,
-    }
+    context = _template_context(project_name, project_username, django_settings,
+                                apache_server_name, apache_server_alias,
+                                server_admin, env_path, branch)
+    sync = louis.sync.Sync()
     # apache config
+    sites = []
     for config_path in local('find $PWD -name "*.apache2"').split('\n'):
+        if not config_path:
+            continue
         d, sep, config_filename = config_path.rpartition('/')
+        sites.append(config_filename)
         dest_path = '/etc/apache2/sites-available/%s' % config_filename
-        if not files.exists(dest_path, use_sudo=True):
-            files.upload_template(config_path, dest_path, context=context, use_sudo=True)
-            sudo('a2ensite %s' % config_filename)
+        sync.add_template(config_path, dest_path, context)
     # wsgi file
     for wsgi_path in local('find $PWD -name "*.wsgi"').split('\n'):
+        if not wsgi_path:
+            continue
         d, sep, wsgi_filename = wsgi_path.rpartition('/')
         dest_path = '/home/%s/%s' % (project_username, wsgi_filename)
-
-        if not files.exists(dest_path, use_sudo=True):
-            files.upload_template(wsgi_path, dest_path, use_sudo=True, context=context)
-            sudo('chown %s:%s %s' % (project_username, 'www-data', dest_path))
-            sudo('chmod 755 %s' % dest_path)
-    with settings(warn_only=True):
-        check_config = sudo('apache2ctl configtest')
+        sync.add_template(wsgi_path, dest_path, context,
+                          owner=project_username, group='www-data', mode='755')
+    # worker limits sized for this host
+    mpm_path = '/etc/apache2/conf.d/louis-mpm'
+    sync.add(tuning.MPM_TEMPLATE % context, mpm_path)
+    changed = sync.run()
+    if not changed:
+        return
+    batch = louis.batch.Batch()
+    for config_filename in sites:
+        if '/etc/apache2/sites-available/%s' % config_filename in changed:
+            batch.add('a2ensite %s' % config_filename)
+    batch.add('apache2ctl configtest', warn_only=True)
+    check_config = batch.run()[-1]
     if check_config.failed:
         print(red('Invalid apache configuration! The requested configuration was installed, but there is a problem with it.'))
+    elif mpm_path in changed:
+        # ServerLimit only changes on a full restart
+        louis.commands.apache_restart()
     else:
         louis.commands.apache_reload()
 
@@ -216,37 +319,102 @@ def setup_project(project_name=project_name,
             # Don't make it an error if the project isn't using south
             with settings(warn_only=True):
                 run('/home/%s/%s/bin/python manage.py migrate --settings=%s' % (project_username, env_path, django_settings))
-                run('/home/%s/%s/bin/python manage.py collectstatic --noinput --settings=%s' % (project_username, env_path, django_settings))
 
     setup_project_apache(project_name, project_username, apache_server_name, apache_server_alias, django_settings, branch=branch)
+    collect_static(project_name, project_username, django_settings)
     update_project()
     print(green("""Project setup complete. You may need to patch the virtualenv
     to install things like mx. You may do so with the patch_virtualenv command."""))
 
 
+def warm_up(project_username=project_username,
+            apache_server_name=apache_server_name,
+            urls=None,
+            wsgi_file_path=wsgi_file_path):
+    """
+    Requests louisconf.WARMUP_URLS (just /) from the vhost on the host until
+    every mod_wsgi daemon of the project has loaded Django, and reports how
+    long each took (see louis.warmup). urls is space separated. Fails when a
+    daemon is still cold after louisconf.WARMUP_TIMEOUT (60s), so a deploy
+    only counts a host as done once it's warm.
+    """
+    if urls is not None:
+        urls = urls.split()
+    warmup.run(project_username, apache_server_name,
+               tuning.wsgi_sizing()['wsgi_processes'], urls, wsgi_file_path)
+
+
+def _build_static():
+    return getattr(conf, 'BUILD_STATIC', False)
+
+
+def collect_static(project_name=project_name,
+                   project_username=project_username,
+                   django_settings=None):
+    """
+    Runs collectstatic in the project's checkout on the host, or ships the
+    locally built files with deploy_static when louisconf.BUILD_STATIC is
+    set.
+    """
+    django_settings = django_settings or _get_django_settings()
+    if _build_static():
+        deploy_static(project_name, project_username, django_settings)
+        return
+    with settings(user=project_username):
+        with cd('/home/%s/%s' % (project_username, project_name)):
+            with settings(warn_only=True):
+                run('/home/%s/%s/bin/python manage.py collectstatic --noinput --settings=%s' % (project_username, env_path, django_settings))
+
+
+def deploy_static(project_name=project_name,
+                  project_username=project_username,
+                  django_settings=None):
+    """
+    Collects the static files once in the local checkout, which has to be at
+    the commit being deployed, compresses them and ships only the changed
+    ones to the host's STATIC_ROOT (see louis.assets). Apache is set up to
+    serve the .gz and .br variants. setup_project and update_project use it
+    instead of a collectstatic on every host when louisconf.BUILD_STATIC is
+    set.
+    """
+    django_settings = django_settings or _get_django_settings()
+    build_dir, manifest = louis.assets.build(django_settings)
+    static_root, static_url = louis.assets.static_location(django_settings)
+    louis.assets.ship(build_dir, manifest, static_root, project_username)
+    sync = louis.sync.Sync()
+    sync.add(louis.assets.APACHE_TEMPLATE % {'static_root': static_root,
+                                             'static_url': static_url},
+             '/etc/apache2/conf.d/louis-static-%s' % project_name)
+    if not sync.run():
+        return
+    batch = louis.batch.Batch()
+    batch.add('a2enmod rewrite headers >/dev/null')
+    batch.add('apache2ctl configtest', warn_only=True)
+    if batch.run()[-1].failed:
+        print(red('Invalid apache configuration! The static files configuration was installed, but there is a problem with it.'))
+    else:
+        # enabling modules needs more than a graceful restart
+        louis.commands.apache_restart()
+
+
 def setup_project_scripts(project_name=project_name,
                           project_username=project_username,
                           django_settings=None,
                           server_admin=server_admin,
                           env_path=env_path):
-    django_settings = django_settings or _get_django_settings()
-    context = {
-        'hostname': env.hostname,
-        'project_name': project_name,
-        'project_username': project_username,
-        'django_settings': django_settings,
-        'env_path': env_path,
-        'server_admin': server_admin,
-    }
+    context = _template_context(project_name, project_username, django_settings,
+                                server_admin=server_admin, env_path=env_path)
     project_path = '/home/%s/%s' % (project_username, project_name)
-    with settings(user=project_username, warn_only=True):
+    sync = louis.sync.Sync()
+    with settings(warn_only=True):
         for path in local('find $PWD/scripts/ -name \*.sh').split('\n'):
             if not path:
                 continue
             filename = os.path.basename(path)
             dest_path = project_path + '/scripts/' + filename
-            files.upload_template(path, dest_path, context=context)
-            run("chmod +x " + dest_path)
+            sync.add_template(path, dest_path, context,
+                              owner=project_username, mode='755')
+    return sync.run()
 
 
 def delete_project_code(project_name=project_name,
@@ -265,51 +433,164 @@ def get_project_head(project_name=project_name,
         with cd('/home/%s/%s' % (project_username, project_name)):
             run('git log -n1')
 
+# Paths whose changes may need syncdb/migrate, on top of louisconf.SCHEMA_PATHS.
+schema_paths = ['*models.py', '*/models/*', '*/migrations/*', '*settings*.py',
+                '*requirements*.txt'] + list(getattr(conf, 'SCHEMA_PATHS', []))
+
+
+def _is_schema_host(name=None):
+    """
+    Schema changes should run once per database, not on every app server.
+    A host runs them if its host_config has "schema-host": True, or if its
+    name is in louisconf.SCHEMA_HOSTS. Once either names a host, hosts that
+    aren't named don't; without either setting every host does, as before.
+    name defaults to the current host.
+    """
+    if name is None:
+        config, name = env.host_config, inventory.hostname()
+    else:
+        config = inventory.host(name).config
+    if "schema-host" in config:
+        return bool(config["schema-host"])
+    schema_hosts = getattr(conf, 'SCHEMA_HOSTS', None)
+    if schema_hosts is not None:
+        return name in schema_hosts
+    return not [h for h in inventory.hosts() if h.config.get("schema-host")]
+
+
+def _schema_decision(migrate, old_head):
+    """
+    Decides whether update_project runs syncdb and migrate after pulling
+    from old_head, None for a first deploy. Returns the decision and the
+    reason for it.
+    """
+    if str(migrate).lower() in ('false', '0'):
+        return False, 'migrate=False was given'
+    if str(migrate).lower() == 'force':
+        return True, 'migrate=force was given'
+    if not _is_schema_host():
+        return False, '%s is not a schema host' % inventory.hostname()
+    if old_head is None:
+        return True, 'this is the first deploy'
+    if old_head.failed:
+        return True, 'the previous HEAD is unknown'
+    changed = run('git diff --name-only %s HEAD' % old_head).split()
+    if not changed:
+        return False, 'no files changed'
+    for path in changed:
+        for pattern in schema_paths:
+            if fnmatch.fnmatch(path, pattern):
+                return True, '%s changed' % path
+    return False, 'none of the %d changed files affect the schema' % len(changed)
+
+
+def _changed_python_files(old_head, new_head='HEAD'):
+    """
+    Returns the .py files removed and the ones added or modified between
+    two commits, following renames and changed submodules.
+    """
+    removed, changed = [], []
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('git diff --raw --no-abbrev -M %s %s' % (old_head, new_head))
+    if output.failed:
+        return removed, changed
+    for line in output.splitlines():
+        # :old_mode new_mode old_sha new_sha status\tpath[\tnew path]
+        fields, tab, paths = line.partition('\t')
+        fields, paths = fields.split(), paths.split('\t')
+        if len(fields) < 5:
+            continue
+        status = fields[4][0]
+        if fields[1] == '160000' and status == 'M':
+            with cd(paths[0]):
+                sub_removed, sub_changed = _changed_python_files(fields[2], fields[3])
+            removed.extend('%s/%s' % (paths[0], p) for p in sub_removed)
+            changed.extend('%s/%s' % (paths[0], p) for p in sub_changed)
+            continue
+        if status in 'DR' and paths[0].endswith('.py'):
+            removed.append(paths[0])
+        if status != 'D' and paths[-1].endswith('.py'):
+            changed.append(paths[-1])
+    return removed, changed
+
+
+def _update_bytecode(old_head, python):
+    """
+    Deletes the .pyc/.pyo files whose source went away in the pull, since
+    python would still import them. Sources that changed are recompiled by
+    python on import, or right away with louisconf.PRECOMPILE_BYTECODE.
+    Without a previous HEAD it falls back to deleting every .pyc.
+    """
+    if old_head.failed:
+        run("find . -name \\*.pyc | xargs rm -f")
+        return
+    removed, changed = _changed_python_files(old_head)
+    if removed:
+        print(green('Removing bytecode of %d deleted modules.' % len(removed)))
+        run('rm -f %s' % ' '.join('%sc %so' % (p, p) for p in removed))
+    if changed and getattr(conf, 'PRECOMPILE_BYTECODE', False):
+        print(green('Compiling %d changed modules.' % len(changed)))
+        with settings(warn_only=True):
+            run('%s -m py_compile %s' % (python, ' '.join(changed)))
+
+
 def update_project(project_name=project_name,
                    project_username=project_username,
                    branch=branch,
                    wsgi_file_path=wsgi_file_path,
                    django_settings=None,
-                   update_requirements=True):
+                   update_requirements=True,
+                   migrate=True):
     """
     Pull the latest source to a project deployed at target_directory. The
     target_directory is relative to project user's home dir. target_directory
     defaults to project_username ie /home/project/project/
     The wsgi path is relative to the target directory and defaults to
     deploy/project_username.wsgi.
+    syncdb and migrate only run on the database's schema host (see
+    _is_schema_host) and only when the pull changed models, migrations,
+    settings or requirements. Pass migrate=False to skip them or
+    migrate=force to run them regardless.
+    The mod_wsgi daemons are warmed up last, before it returns (see warm_up).
     """
     django_settings = django_settings or _get_django_settings()
     print ("Using %s for django settings module." % django_settings)
-    template_context = {
-        "env_path": env_path,
-        "project_username": project_username,
-        "project_name": project_name,
-        "django_settings": django_settings,
-        "hostname": env.hostname,
-    }
     with settings(user=project_username):
         with cd('/home/%s/%s' % (project_username, project_name)):
-            run("find . -name \\*.pyc | xargs rm")
-            run('git checkout %s' % branch)
-            run('git pull')
-            run('git submodule update')
-            # Don't make it an error if the project isn't using south
             with settings(warn_only=True):
-                run('/home/%s/%s/bin/python manage.py syncdb --settings=%s --noinput' % (project_username, env_path, django_settings))
-                run('/home/%s/%s/bin/python manage.py migrate --settings=%s' % (project_username, env_path, django_settings))
+                old_head = run('git rev-parse HEAD')
+            run(' && '.join(['git checkout -q %s' % branch, 'git pull -q',
+                             gitcache.submodules_command()]))
+            _update_bytecode(old_head, '/home/%s/%s/bin/python' % (project_username, env_path))
+            run_schema, reason = _schema_decision(migrate, old_head)
+            print(green('Schema steps: %s, %s.' % (run_schema and 'running' or 'skipped', reason)))
+            # Don't make it an error if the project isn't using south
+            if run_schema:
+                with settings(warn_only=True):
+                    run('/home/%s/%s/bin/python manage.py syncdb --settings=%s --noinput' % (project_username, env_path, django_settings))
+                    run('/home/%s/%s/bin/python manage.py migrate --settings=%s' % (project_username, env_path, django_settings))
             if update_requirements is True:
                 install_project_requirements(project_username, requirements_path,  env_path)
             run('touch %s' % wsgi_file_path)
-            if hasattr(conf, "CRONTAB"):
-                print "Setting up crontab"
-                # FIXME It is kind hacky the creation of a temporary file
-                # here, but we need to make it consistent with LOGROTATE.
-                temp_dest = "/tmp/%s.crontab" % project_name
-                # Fabric tries to keep a backup of the same file sometimes
-                with settings(warn_only=True):
-                    files.upload_template(conf.CRONTAB, temp_dest, context=template_context)
-                run("crontab %s && rm %s" % (temp_dest, temp_dest))
-    if hasattr(conf, "LOGROTATE"):
-        print "Setting up logrotate"
-        files.upload_template(conf.LOGROTATE, "/etc/logrotate.d/%s" % project_name, context=template_context, use_sudo=True)
+    if _build_static():
+        deploy_static(project_name, project_username, django_settings)
+    _setup_crontab_and_logrotate(project_name, project_username, django_settings)
     setup_project_scripts(project_name, project_username, django_settings, server_admin, env_path)
+    # last, deploy_static may restart apache
+    warm_up(project_username, wsgi_file_path=wsgi_file_path)
+
+
+def _setup_crontab_and_logrotate(project_name, project_username, django_settings):
+    template_context = _template_context(project_name, project_username, django_settings)
+    sync = louis.sync.Sync()
+    crontab_path = '/home/%s/.louis-crontab' % project_username
+    if hasattr(conf, "CRONTAB"):
+        sync.add_template(conf.CRONTAB, crontab_path, template_context,
+                          owner=project_username)
+    if hasattr(conf, "LOGROTATE"):
+        sync.add_template(conf.LOGROTATE, "/etc/logrotate.d/%s" % project_name,
+                          template_context)
+    if crontab_path in sync.run():
+        print "Setting up crontab"
+        with settings(user=project_username):
+            run("crontab %s" % crontab_path)
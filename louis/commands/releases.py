@@ -0,0 +1,261 @@
+from __future__ import with_statement
+import time
+
+from fabric.api import run, sudo, cd, settings, hide, abort
+from fabric.contrib import files
+from fabric.colors import green
+from louis import conf
+from louis import gitcache
+import louis.assets
+import louis.commands
+from louis.commands.projects import (project_name, project_username, branch,
+    git_url, env_path, wsgi_file_path, server_admin, virtualenv_use_site_packages,
+    media_directory, install_project_requirements, setup_project_scripts,
+    deploy_static, _get_django_settings, _build_static, _schema_decision,
+    _setup_crontab_and_logrotate, warm_up)
+
+# Release layout in the project user's home directory:
+#
+#   <project>.git          bare mirror of the repository, fetched every deploy
+#   releases/<timestamp>/  one checkout per deploy
+#   venvs/<sha1>/          virtualenvs named after the requirements file hash,
+#                          shared by every release with the same requirements
+#   shared/<dir>/          directories that outlive releases, such as media/,
+#                          linked into every release (see _shared_dirs)
+#   <project>              symlink to the live release
+#   <env_path>             symlink to <project>/.louis-venv, which every
+#                          release points at its own virtualenv
+#
+# Templates keep using /home/<user>/<project> and env_path, and switching the
+# <project> symlink switches code and virtualenv at once.
+
+releases_keep = getattr(conf, 'RELEASES_KEEP', 5)
+
+
+def _home(project_username):
+    return '/home/%s' % project_username
+
+
+def _switch(target, link):
+    """Points link at target with an atomic rename."""
+    run('ln -sfn %s %s.louis-new && mv -T %s.louis-new %s' %
+        (target, link, link, link))
+
+
+def _releases():
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('ls -1 releases')
+    if output.failed:
+        return []
+    return sorted(output.split())
+
+
+def _current_release(project_name):
+    with settings(hide('running', 'stdout'), warn_only=True):
+        target = run('readlink %s' % project_name)
+    if target.failed or not target.startswith('releases/'):
+        return None
+    return target.rpartition('/')[2]
+
+
+def _shared_dirs(project_name, project_username, django_settings):
+    """
+    The directories, relative to a release, that are kept in shared/ and
+    linked into every release: louisconf.RELEASE_SHARED_DIRS, by default the
+    media directory, and STATIC_ROOT when deploy_static ships into the tree.
+    """
+    checkout = '%s/%s/' % (_home(project_username), project_name)
+    default = []
+    if media_directory.startswith(checkout):
+        default.append(media_directory[len(checkout):].strip('/'))
+    shared = list(getattr(conf, 'RELEASE_SHARED_DIRS', default))
+    if _build_static():
+        static_root = louis.assets.static_location(django_settings)[0]
+        if static_root.startswith(checkout):
+            shared.append(static_root[len(checkout):].strip('/'))
+    return shared
+
+
+def _link_shared(project_username, path, previous, shared):
+    """
+    Links the shared directories into the release at path. Files of a
+    release deployed before the directory was shared are moved to shared/
+    first, and the old release is linked too, so rolling back keeps them.
+    """
+    for directory in shared:
+        target = '%s/shared/%s' % (_home(project_username), directory)
+        if previous:
+            old = 'releases/%s/%s' % (previous, directory)
+            run('if [ ! -e %s ] && [ -d %s ] && [ ! -L %s ]; then '
+                'mkdir -p `dirname %s` && mv %s %s && ln -s %s %s; fi' %
+                (target, old, old, target, old, target, target, old))
+        run('mkdir -p %s' % target)
+        run('rm -rf %s/%s && mkdir -p `dirname %s/%s` && ln -s %s %s/%s' %
+            (path, directory, path, directory, target, path, directory))
+
+
+def _adopt_checkout(project_name, project_username, env_path):
+    """
+    Turns an in-place checkout and virtualenv into the first release, so
+    that hosts set up by setup_project can move to release deploys.
+    """
+    release = time.strftime('%Y%m%d%H%M%S') + '-adopted'
+    print(green('Adopting the existing checkout as release %s' % release))
+    run('mkdir -p releases venvs')
+    run('mv %s releases/%s' % (project_name, release))
+    run('mv %s venvs/adopted' % env_path)
+    run('ln -s ../../venvs/adopted releases/%s/.louis-venv' % release)
+    run('ln -s releases/%s %s' % (release, project_name))
+    run('ln -s %s/%s/.louis-venv %s' %
+        (_home(project_username), project_name, env_path))
+
+
+def _build_venv(project_username, requirements, site_packages):
+    """
+    Returns the release's virtualenv, creating it only if no other release
+    has the same requirements.
+    """
+    with settings(hide('running', 'stdout')):
+        digest = run('sha1sum < %s | cut -c1-40' % requirements)
+    venv = 'venvs/%s' % digest
+    if files.exists('%s/.louis-complete' % venv):
+        print(green('Reusing virtualenv %s' % venv))
+        return venv
+    run('rm -rf %s' % venv)
+    if site_packages:
+        run('virtualenv %s' % venv)
+    else:
+        run('virtualenv --no-site-packages %s' % venv)
+    run('%s/bin/easy_install -U setuptools' % venv)
+    run('%s/bin/easy_install pip' % venv)
+    install_project_requirements(project_username, requirements, venv)
+    run('touch %s/.louis-complete' % venv)
+    return venv
+
+
+def deploy_release(project_name=project_name,
+                   project_username=project_username,
+                   git_url=git_url,
+                   branch=branch,
+                   django_settings=None,
+                   migrate=True):
+    """
+    Deploys the branch as a new release directory and switches to it
+    atomically. Requests are never served from a half updated tree, and
+    rollback switches back to the previous release.
+
+    The first run moves an existing setup_project checkout into releases/.
+    Uploads and other files that must outlive a release live in shared/
+    (see _shared_dirs). Old releases are pruned, keeping
+    louisconf.RELEASES_KEEP (5).
+    """
+    django_settings = django_settings or _get_django_settings()
+    release = time.strftime('%Y%m%d%H%M%S')
+    shared = _shared_dirs(project_name, project_username, django_settings)
+    with settings(user=project_username):
+        with cd(_home(project_username)):
+            if files.exists(project_name) and not _current_release(project_name):
+                _adopt_checkout(project_name, project_username, env_path)
+            previous = _current_release(project_name)
+            mirror = gitcache.update_mirror(project_name, git_url)
+            path = 'releases/%s' % release
+            run('mkdir -p releases venvs')
+            run('git clone -q %s %s' % (mirror, path))
+            with cd(path):
+                run('git remote set-url origin %s' % git_url)
+                run('git checkout -q %s' % branch)
+                run(gitcache.submodules_command())
+            venv = _build_venv(project_username,
+                               '%s/deploy/requirements.txt' % path,
+                               virtualenv_use_site_packages)
+            run('ln -s ../../%s %s/.louis-venv' % (venv, path))
+            if not files.exists(env_path):
+                run('mkdir -p `dirname %s`' % env_path)
+                run('ln -s %s/%s/.louis-venv %s' %
+                    (_home(project_username), project_name, env_path))
+            with cd(path):
+                old_head = None
+                if previous:
+                    with settings(warn_only=True):
+                        old_head = run('git --git-dir=../%s/.git rev-parse HEAD' % previous)
+                run_schema, reason = _schema_decision(migrate, old_head)
+                print(green('Schema steps: %s, %s.' % (run_schema and 'running' or 'skipped', reason)))
+                if run_schema:
+                    # Don't make it an error if the project isn't using south
+                    with settings(warn_only=True):
+                        run('.louis-venv/bin/python manage.py syncdb --settings=%s --noinput' % django_settings)
+                        run('.louis-venv/bin/python manage.py migrate --settings=%s' % django_settings)
+            _link_shared(project_username, path, previous, shared)
+            _switch(path, project_name)
+            run('touch %s' % wsgi_file_path)
+            print(green('Release %s is live.' % release))
+    with cd(_home(project_username)):
+        for directory in shared:
+            # writable by apache, as setup_project_apache does for media/
+            sudo('chgrp www-data -R shared/%s' % directory)
+            sudo('chmod g+w shared/%s' % directory)
+    if _build_static():
+        deploy_static(project_name, project_username, django_settings)
+    _setup_crontab_and_logrotate(project_name, project_username, django_settings)
+    setup_project_scripts(project_name, project_username, django_settings, server_admin, env_path)
+    prune_releases(project_name, project_username)
+    # last, deploy_static may restart apache
+    warm_up(project_username)
+
+
+def rollback(project_name=project_name,
+             project_username=project_username,
+             release=None):
+    """
+    Switches back to the release before the live one, or to the given
+    release, and reloads apache. Database migrations are not reverted.
+    """
+    with settings(user=project_username):
+        with cd(_home(project_username)):
+            releases = _releases()
+            current = _current_release(project_name)
+            if current is None:
+                abort('%s is not deployed as a release, there is nothing to roll '
+                      'back to. Use deploy_release to deploy releases.' % project_name)
+            if release is None:
+                older = [r for r in releases if r < current]
+                if not older:
+                    abort('There is no release before %s.' % current)
+                release = older[-1]
+            elif release not in releases:
+                abort('Unknown release %s. Available: %s' % (release, ', '.join(releases)))
+            _switch('releases/%s' % release, project_name)
+            run('touch %s' % wsgi_file_path)
+    louis.commands.apache_reload()
+    warm_up(project_username)
+    print(green('Rolled back from %s to %s.' % (current, release)))
+
+
+def list_releases(project_name=project_name,
+                  project_username=project_username):
+    """Lists the deployed releases and marks the live one."""
+    with settings(user=project_username):
+        with cd(_home(project_username)):
+            current = _current_release(project_name)
+            for release in _releases():
+                print('%s %s' % (release == current and '*' or ' ', release))
+
+
+def prune_releases(project_name=project_name,
+                   project_username=project_username,
+                   keep=releases_keep):
+    """
+    Deletes all but the newest keep releases, never the live one, and the
+    virtualenvs no release uses anymore.
+    """
+    with settings(user=project_username):
+        with cd(_home(project_username)):
+            current = _current_release(project_name)
+            old = [r for r in _releases()[:-int(keep)] if r != current]
+            if old:
+                print(green('Pruning releases %s' % ', '.join(old)))
+                run('rm -rf %s' % ' '.join('releases/%s' % r for r in old))
+            # virtualenvs that no remaining release links to
+            run('for v in venvs/*; do '
+                'ls -l releases/*/.louis-venv 2>/dev/null | grep -q "$v\\$" '
+                '|| rm -rf "$v"; done')
@@ -1,45 +1,54 @@
 from __future__ import with_statement
 from fabric.api import run, put, sudo, env, cd, local, prompt, settings
 from fabric.contrib import files
+from louis import accounts
 from louis import conf
+from louis import facts
+from louis import state
+import louis.batch
 
 
-def add_ssh_keys(target_username, ssh_key_path):
+def add_ssh_keys(target_username, ssh_key_path, batch=None):
     """
-    cats the file at ssh_key_path (local) to the target username's authorized_keys.
+    Adds the keys in the file at ssh_key_path (local) to the target username's
+    authorized_keys, skipping the ones that are already there.
     """
+    own_batch = batch is None
+    if own_batch:
+        batch = louis.batch.Batch()
     with cd('/home/%s' % target_username):
-        sudo('mkdir -p .ssh')
-        put(ssh_key_path, '/tmp/keys')
-        sudo("cp /tmp/keys .")
-        sudo('cat keys >> .ssh/authorized_keys')
-        sudo('chown -R %s:%s .ssh/' % (target_username, target_username))
-        sudo('rm -f /tmp/keys')
+        batch.add('mkdir -p .ssh')
+        batch.append(accounts.read_keys(ssh_key_path), '.ssh/authorized_keys')
+        batch.add('chown -R %s:%s .ssh/' % (target_username, target_username))
+    if own_batch:
+        batch.run()
 
 
-def create_group(groupname):
+def create_group(groupname, batch=None):
     """Creates group if it doesn't already exist."""
+    if batch is not None:
+        batch.add('groupadd %s' % groupname, warn_only=True)
+        return
     with settings(warn_only=True):
         sudo('groupadd %s' % groupname)
 
 
-def create_user(username, ssh_key_path, shell='bash', admin=False, password=None):
+def create_user(username, ssh_key_path, shell='bash', admin=False, password=None,
+                batch=None):
     """
     Creates a user. The ssh_key_path argument is required and should be an
-    absolute path to a local key file. The file will be concatenated to
+    absolute path to a local key file. The keys in it are added to
     authorized_keys, so it can contain multiple keys. Pass admin=True for new
-    user to be an admin.
+    user to be an admin. Running it for an existing user adds missing keys
+    and groups (see louis.accounts).
     """
-    # TODO: check if user exists and return if so
-    with settings(warn_only=True):
-        if not sudo('grep "%s:" /etc/passwd' % username).failed:
-            return
-    if admin:
-        create_group('admin')
-        sudo('useradd -G admin -m -s `which %s` %s' % (shell, username))
-    else:
-        sudo('useradd -m -s `which %s` %s' % (shell, username))
-    add_ssh_keys(target_username=username, ssh_key_path=ssh_key_path)
+    wanted = {username: accounts.account(accounts.read_keys(ssh_key_path), shell,
+                                         admin and ['admin'] or [])}
+    if batch is not None:
+        accounts.sync(wanted, batch=batch)
+        return
+    if accounts.sync(wanted):
+        facts.invalidate()
 
 
 def delete_user(username):
@@ -49,18 +58,26 @@ def delete_user(username):
     sudo('userdel -r %s' % username)
 
 
+@state.step(lambda: sorted((u, s['shell'], open(s['ssh_key_path']).read())
+                           for u, s in conf.SYSADMINS.items()))
 def create_sysadmins():
-    """Creates users for every entry in louisconf.SYSADMINS."""
-    for u,s in conf.SYSADMINS.iteritems():
-        create_user(u, s['ssh_key_path'], shell=s['shell'], admin=True)
+    """
+    Creates users for every entry in louisconf.SYSADMINS, or brings their
+    shells, groups and keys up to date, in one round trip.
+    """
+    if accounts.sync(accounts.sysadmins()):
+        facts.invalidate()
 
 
+@state.step()
 def config_sudo():
     """Changes sudo configuration so that members of the admin group can gain
     root privileges without password."""
     txt = ['# Members of the admin group may gain root privileges',
            '# They can run any command as root with no password',
            '%admin ALL=(ALL) NOPASSWD: ALL']
-    files.append(txt, '/etc/sudoers', use_sudo=True)
+    batch = louis.batch.Batch()
+    batch.append(txt, '/etc/sudoers')
+    batch.run()
 
 
@@ -0,0 +1,64 @@
+"""
+Bookkeeping for the SSH connections fabric opens.
+
+Fabric already keeps one connection per host string for the whole session
+(fabric.state.connections) and every run/sudo/put opens a channel on it. This
+module counts the connections and channels that are opened, and turns on
+keepalives so that the session's connection survives long silent commands
+such as apt-get upgrade instead of being dropped and opened again.
+"""
+import atexit
+
+import paramiko
+from fabric import network
+from louis import conf
+
+stats = {}
+
+
+def _host_stats(host):
+    return stats.setdefault(host, {'connections': 0, 'channels': 0})
+
+
+def _counting_connect(connect):
+    def wrapper(user, host, port, *args, **kwargs):
+        client = connect(user, host, port, *args, **kwargs)
+        _host_stats(host)['connections'] += 1
+        transport = client.get_transport()
+        transport._louis_host = host
+        keepalive = getattr(conf, 'SSH_KEEPALIVE', 30)
+        if keepalive:
+            transport.set_keepalive(keepalive)
+        return client
+    return wrapper
+
+
+def _counting_open_channel(open_channel):
+    def wrapper(self, *args, **kwargs):
+        channel = open_channel(self, *args, **kwargs)
+        host = getattr(self, '_louis_host', None)
+        if host:
+            _host_stats(host)['channels'] += 1
+        return channel
+    return wrapper
+
+
+def report():
+    if not stats:
+        return
+    print('SSH usage:')
+    for host, counts in sorted(stats.items()):
+        print('  %-30s %3d connections, %4d channels' %
+              (host, counts['connections'], counts['channels']))
+
+
+def install():
+    """Starts counting. Calling it more than once has no effect."""
+    if getattr(network.connect, '_louis_counting', False):
+        return
+    network.connect = _counting_connect(network.connect)
+    network.connect._louis_counting = True
+    paramiko.Transport.open_channel = _counting_open_channel(
+        paramiko.Transport.open_channel)
+    if getattr(conf, 'SHOW_CONNECTION_STATS', False):
+        atexit.register(report)
@@ -0,0 +1,147 @@
+"""
+Facts about a host, gathered in one round trip and cached locally.
+
+get() runs a single batched probe for the host's users, groups, installed
+packages, enabled apache sites, CPU count, memory, OS release, disk type
+(hdd or ssd) and installed postgres versions, and keeps the answer in memory
+and in louisconf.FACTS_DIR (~/.louis/facts) for louisconf.FACTS_TTL seconds
+(600). Tasks consult the facts instead of probing
+the host themselves, and call invalidate() after changing what they describe.
+While a plan backend is installed (see louis.backends) the fake host's facts
+are kept in memory only, so they never stand in for a real host's.
+"""
+import os
+import re
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fabric.api import env
+from fabric.contrib import files
+from louis import backends
+from louis import conf
+import louis.batch
+
+_facts = {}
+
+_probes = [
+    ('users', 'cut -d: -f1 /etc/passwd'),
+    ('groups', 'cut -d: -f1 /etc/group'),
+    ('packages', "dpkg-query -W -f='${Package} ${Version} ${Status}\\n' 2>/dev/null"),
+    ('sites', 'ls -1 /etc/apache2/sites-enabled 2>/dev/null'),
+    ('cpus', 'grep -c ^processor /proc/cpuinfo'),
+    ('memory_mb', "awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo"),
+    ('os', 'lsb_release -ds 2>/dev/null || head -n1 /etc/issue.net'),
+    ('disk', 'cat /sys/block/[hsv]d*/queue/rotational '
+             '/sys/block/nvme*/queue/rotational 2>/dev/null'),
+    ('postgres_versions', 'ls -1 /etc/postgresql 2>/dev/null'),
+]
+
+
+def _cache_path():
+    directory = os.path.expanduser(getattr(conf, 'FACTS_DIR', '~/.louis/facts'))
+    return os.path.join(directory, '%s.json' %
+                        re.sub(r'[^\w.@-]', '_', env.host_string))
+
+
+def _parse(name, output):
+    lines = [l.strip() for l in output.splitlines() if l.strip()]
+    if name == 'packages':
+        packages = {}
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 5 and fields[2:] == ['install', 'ok', 'installed']:
+                packages[fields[0]] = fields[1]
+        return packages
+    if name in ('cpus', 'memory_mb'):
+        return lines and int(lines[0]) or 0
+    if name == 'os':
+        return lines and lines[0].strip('"') or ''
+    if name == 'disk':
+        # any spinning disk makes the host count as one
+        return '1' in lines and 'hdd' or (lines and 'ssd' or 'unknown')
+    return lines
+
+
+def gather():
+    """Probes the host in one round trip and caches the result."""
+    batch = louis.batch.Batch()
+    for name, command in _probes:
+        batch.add(command, warn_only=True)
+    results = batch.run(quiet=True)
+    facts = {'gathered': time.time(), 'paths': {}}
+    for (name, command), result in zip(_probes, results):
+        facts[name] = _parse(name, result)
+    _facts[env.host_string] = facts
+    _save(facts)
+    return facts
+
+
+def _save(facts):
+    if backends.installed():
+        return
+    path = _cache_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    cache_file = open(path, 'w')
+    try:
+        json.dump(facts, cache_file)
+    finally:
+        cache_file.close()
+
+
+def _load():
+    if backends.installed():
+        return None
+    try:
+        cache_file = open(_cache_path())
+    except IOError:
+        return None
+    try:
+        try:
+            return json.load(cache_file)
+        except ValueError:
+            return None
+    finally:
+        cache_file.close()
+
+
+def _fresh(facts):
+    ttl = getattr(conf, 'FACTS_TTL', 600)
+    if not facts or [n for n, c in _probes if n not in facts]:
+        # gathered by a louis that probed less
+        return False
+    return time.time() - facts['gathered'] < ttl
+
+
+def get():
+    """Returns the host's facts, gathering them only when the cache is stale."""
+    facts = _facts.get(env.host_string)
+    if not _fresh(facts):
+        facts = _load()
+    if not _fresh(facts):
+        facts = gather()
+    _facts[env.host_string] = facts
+    return facts
+
+
+def invalidate():
+    """Forgets the host's facts; the next get() gathers them again."""
+    _facts.pop(env.host_string, None)
+    if not backends.installed() and os.path.exists(_cache_path()):
+        os.remove(_cache_path())
+
+
+def exists(path):
+    """
+    Like fabric.contrib.files.exists, but answers from the facts when the
+    path was already checked.
+    """
+    facts = get()
+    if path not in facts['paths']:
+        facts['paths'][path] = files.exists(path, use_sudo=True)
+        _save(facts)
+    return facts['paths'][path]
@@ -0,0 +1,69 @@
+"""
+Git commands for fast checkouts.
+
+The project user's home keeps a bare mirror of the repository,
+<project>.git, which deploy_release clones releases from. With
+louisconf.GIT_REFERENCE_CACHE set, setup_project_code clones with
+--reference to that mirror too, so the objects come from the host's disk
+instead of the network. The checkout then copies the objects it borrowed
+and stops using the mirror, since the mirror prunes deleted and rewritten
+branches and its gc would take objects the checkout still has branches
+for. louisconf.GIT_SHALLOW_DEPTH makes the clone shallow
+and limits it to the deploy branch. Submodules are fetched
+louisconf.GIT_SUBMODULE_JOBS (4) at a time where git supports it.
+"""
+from fabric.api import run
+from louis import conf
+
+
+def mirror_path(project_name):
+    """The mirror, relative to the project user's home directory."""
+    return '%s.git' % project_name
+
+
+def mirror_command(project_name, git_url):
+    """Creates the mirror, or fetches into it when it exists."""
+    mirror = mirror_path(project_name)
+    return ('if [ -d %s ]; then git --git-dir=%s fetch -q --prune; '
+            'else git clone -q --mirror %s %s; fi' % (mirror, mirror, git_url, mirror))
+
+
+def update_mirror(project_name, git_url):
+    run(mirror_command(project_name, git_url))
+    return mirror_path(project_name)
+
+
+def use_cache():
+    return getattr(conf, 'GIT_REFERENCE_CACHE', False)
+
+
+def clone_command(project_name, git_url, branch):
+    shallow = getattr(conf, 'GIT_SHALLOW_DEPTH', None)
+    options = ['-q', '--branch %s' % branch]
+    if use_cache():
+        options.append('--reference %s' % mirror_path(project_name))
+    if shallow:
+        options.append('--depth %d --single-branch' % int(shallow))
+    command = 'git clone %s %s %s' % (' '.join(options), git_url, project_name)
+    if use_cache():
+        # what --dissociate does, for git before 2.3
+        command += (' && (cd %s && git repack -a -d -q && '
+                    'rm -f .git/objects/info/alternates)' % project_name)
+    return command
+
+
+def submodules_command():
+    jobs = getattr(conf, 'GIT_SUBMODULE_JOBS', 4)
+    # --jobs needs git 2.9
+    return ('(git submodule -q update --init --jobs %d 2>/dev/null || '
+            'git submodule -q update --init)' % jobs)
+
+
+def track_branches_command(branch):
+    """
+    Creates a local tracking branch for every remote branch but HEAD and
+    branch, which the clone checked out, in one command.
+    """
+    return ("git for-each-ref --format='%%(refname)' refs/remotes/origin | "
+            "sed 's#^refs/remotes/origin/##' | grep -vx -e HEAD -e %s | "
+            "xargs -r -I{} git branch -q --track {} origin/{}" % branch)
@@ -0,0 +1,199 @@
+"""
+Runs provisioning steps as a dependency graph instead of a fixed sequence.
+
+A graph is a list of (task, requires, locks) tuples: the fab task to run
+(with arguments, as on the fab command line), the tasks that have to finish
+first and the resources it can't share with another step, such as dpkg's
+lock. run() starts every step whose requirements are done and whose locks
+are free, up to a pool size, each in its own fab process (fabric's env isn't
+thread safe, see louis.workers). A failed step skips everything that
+depends on it, and the rest carries on.
+
+The report lists when each step started and how long it took, and the
+critical path: the chain of dependencies that bounds the run however many
+steps run at once.
+"""
+import threading
+import time
+from Queue import Queue, Empty
+
+from fabric.api import abort
+from fabric.colors import green, red, yellow
+from louis import workers
+
+INIT_SERVER = [
+    ('config_system', (), ()),
+    ('update', ('config_system',), ('dpkg',)),
+    ('install_debconf_seeds', ('update',), ('dpkg',)),
+    ('install_server_packages', ('install_debconf_seeds',), ('dpkg',)),
+    ('install_basic_packages', ('install_server_packages',), ('dpkg',)),
+    ('config_apticron', ('install_basic_packages',), ()),
+    ('config_exim', ('install_basic_packages',), ()),
+    ('create_sysadmins', ('config_system',), ('passwd',)),
+    ('config_sudo', ('create_sysadmins',), ()),
+    ('install_apache', ('install_server_packages',), ('dpkg',)),
+    ('install_postgres', ('install_server_packages',), ('dpkg',)),
+    ('install_memcached', ('install_server_packages',), ('dpkg',)),
+    # only lock root out once the admins can log in and sudo
+    ('config_sshd', ('config_sudo', 'install_basic_packages'), ()),
+]
+
+# Unlike setup_project, nothing waits for the project user's public key to
+# be added to the repository before the clone: its steps run unattended, so
+# the deploy key has to be authorised already (or the repository public).
+SETUP_PROJECT = [
+    ('setup_project_user', (), ('passwd',)),
+    # createdb runs as the project user
+    ('setup_postgres', ('setup_project_user',), ()),
+    ('setup_project_code', ('setup_project_user',), ()),
+    ('setup_project_virtualenv', ('setup_project_user',), ()),
+    ('install_project_requirements', ('setup_project_code',
+                                      'setup_project_virtualenv'), ()),
+    ('setup_project_apache', ('setup_project_code',), ('apache',)),
+    ('collect_static', ('install_project_requirements',
+                        'setup_project_apache'), ('apache',)),
+    ('update_project:migrate=force', ('install_project_requirements',
+                                      'setup_postgres',
+                                      'collect_static'), ('apache',)),
+]
+
+GRAPHS = {
+    'init_server': INIT_SERVER,
+    'setup_project': SETUP_PROJECT,
+}
+
+
+def _name(task):
+    return task.split(':', 1)[0]
+
+
+def check(steps):
+    """Aborts on unknown requirements and cycles."""
+    names = [_name(task) for task, requires, locks in steps]
+    for task, requires, locks in steps:
+        unknown = [r for r in requires if r not in names]
+        if unknown:
+            abort('%s requires unknown steps: %s' % (task, ', '.join(unknown)))
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [s for s in remaining if set(s[1]) <= done]
+        if not ready:
+            abort('Steps depend on each other in a cycle: %s' %
+                  ', '.join(_name(s[0]) for s in remaining))
+        for step in ready:
+            done.add(_name(step[0]))
+            remaining.remove(step)
+
+
+def without(steps, names):
+    """Drops the named steps, and drops them from the others' requirements."""
+    return [(task, tuple(r for r in requires if r not in names), locks)
+            for task, requires, locks in steps if _name(task) not in names]
+
+
+def run(steps, command, pool_size=4):
+    """
+    Runs the steps. command(task) returns the fab command line for one
+    task. Returns {step name: job}, with skipped steps missing.
+    """
+    check(steps)
+    pending = list(steps)
+    running = {}
+    held = set()
+    jobs = {}
+    started = {}
+    skipped = []
+    finished = Queue()
+    start = time.time()
+
+    def work(name, job):
+        job.run()
+        finished.put(name)
+
+    while pending or running:
+        for step in list(pending):
+            task, requires, locks = step
+            name = _name(task)
+            if [r for r in requires if r in skipped or
+                    (r in jobs and r not in running and jobs[r].failed)]:
+                print(yellow('%s skipped, a step it requires failed' % name))
+                skipped.append(name)
+                pending.remove(step)
+            elif (len(running) < max(1, int(pool_size)) and
+                    not [r for r in requires if r not in jobs or r in running] and
+                    not set(locks) & held):
+                job = workers.Job(name, command(task))
+                jobs[name] = running[name] = job
+                held.update(locks)
+                started[name] = time.time() - start
+                pending.remove(step)
+                thread = threading.Thread(target=work, args=(name, job))
+                thread.setDaemon(True)
+                thread.start()
+        if not running:
+            continue
+        while True:
+            # poll with a timeout so that ctrl-c still reaches us
+            try:
+                name = finished.get(timeout=0.5)
+                break
+            except Empty:
+                pass
+        job = running.pop(name)
+        for task, requires, locks in steps:
+            if _name(task) == name:
+                held.difference_update(locks)
+        if job.failed:
+            print(red('%s failed after %.1fs' % (name, job.duration)))
+        else:
+            print(green('%s done in %.1fs' % (name, job.duration)))
+    _report(steps, jobs, started, time.time() - start)
+    return jobs
+
+
+def critical_path(steps, jobs):
+    """Returns the longest chain of dependencies, by duration, and its length."""
+    finish = {}
+    previous = {}
+    for task, requires, locks in _ordered(steps):
+        name = _name(task)
+        if name not in jobs:
+            continue
+        before = [r for r in requires if r in finish]
+        slowest = before and max(before, key=lambda r: finish[r]) or None
+        finish[name] = jobs[name].duration + (slowest and finish[slowest] or 0)
+        previous[name] = slowest
+    if not finish:
+        return [], 0
+    name = max(finish, key=lambda n: finish[n])
+    total = finish[name]
+    path = []
+    while name:
+        path.insert(0, name)
+        name = previous[name]
+    return path, total
+
+
+def _ordered(steps):
+    done = set()
+    remaining = list(steps)
+    ordered = []
+    while remaining:
+        for step in [s for s in remaining if set(s[1]) <= done]:
+            done.add(_name(step[0]))
+            remaining.remove(step)
+            ordered.append(step)
+    return ordered
+
+
+def _report(steps, jobs, started, wall):
+    print(green('Schedule:'))
+    for name in sorted(jobs, key=lambda n: started[n]):
+        job = jobs[name]
+        print('  %6.1fs %6.1fs %-6s %s' % (started[name], job.duration,
+                                           job.failed and 'FAILED' or 'ok', name))
+    path, total = critical_path(steps, jobs)
+    serial = sum(j.duration for j in jobs.values())
+    print('Critical path (%.1fs): %s' % (total, ' -> '.join(path)))
+    print('Wall time %.1fs, %.1fs if run one after the other' % (wall, serial))
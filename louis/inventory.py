@@ -0,0 +1,183 @@
+"""
+The hosts louis knows about, indexed by name, address, role and tag.
+
+Hosts come from louisconf.HOSTS, entries of (address, name) or (address,
+name, config). The config may list the host's "roles" and "tags", e.g.
+
+    ("10.0.0.5", "web5", {"roles": ["web"], "tags": ["eu-west", "canary"]})
+
+Nothing is read until a task asks for a host, and the indexes are built
+once, so looking a host up costs the same with five hosts or five thousand.
+
+select() takes a selector: a host name, "role:<pattern>", "tag:<pattern>"
+or "name:<pattern>", where patterns may use shell wildcards (tag:eu-*).
+Several selectors separated by semicolons select every host matching any of
+them.
+
+Several entries may share an address, e.g. staging and production on one
+server. The host a task runs on is the one picked by name (with on or the
+host's task, see choose()); the address alone only identifies it when the
+entries sharing it have the same config.
+"""
+import fnmatch
+
+from fabric.api import env, abort
+from louis import conf
+
+_index = {}
+_chosen = {}
+
+
+class Host(object):
+
+    def __init__(self, entry):
+        self.address, self.name = entry[:2]
+        self.config = len(entry) > 2 and entry[2] or {}
+        self.roles = list(self.config.get('roles', []))
+        self.tags = list(self.config.get('tags', []))
+
+    def __repr__(self):
+        return '<Host %s %s>' % (self.name, self.address)
+
+
+def _load():
+    if _index:
+        return _index
+    hosts = [Host(entry) for entry in conf.HOSTS]
+    _index['hosts'] = hosts
+    _index['name'] = dict((h.name, h) for h in hosts)
+    for key in ('address', 'role', 'tag'):
+        _index[key] = {}
+    for host in hosts:
+        _index['address'].setdefault(host.address, []).append(host)
+        for role in host.roles:
+            _index['role'].setdefault(role, []).append(host)
+        for tag in host.tags:
+            _index['tag'].setdefault(tag, []).append(host)
+    return _index
+
+
+def hosts():
+    """Every host, in louisconf.HOSTS order."""
+    return list(_load()['hosts'])
+
+
+def host(name):
+    """The host called name; aborts when there's none."""
+    found = _load()['name'].get(name)
+    if found is None:
+        abort('Unknown host %s' % name)
+    return found
+
+
+def with_role(role):
+    """The hosts with the role, possibly none."""
+    return list(_load()['role'].get(role, []))
+
+
+def _matching(index, pattern):
+    if not [c for c in pattern if c in '*?[']:
+        found = index.get(pattern, [])
+        if not isinstance(found, list):
+            found = [found]
+        return found
+    found = []
+    for key in sorted(index):
+        if fnmatch.fnmatch(key, pattern):
+            values = index[key]
+            if not isinstance(values, list):
+                values = [values]
+            found.extend(values)
+    return found
+
+
+def select(selector):
+    """
+    Returns the hosts matching the selector, in louisconf.HOSTS order.
+    Aborts when a part of the selector matches nothing.
+    """
+    index = _load()
+    selected = set()
+    for term in [t.strip() for t in selector.split(';') if t.strip()]:
+        kind, sep, pattern = term.partition(':')
+        if not sep:
+            kind, pattern = 'name', term
+        if kind not in ('name', 'role', 'tag'):
+            abort('Unknown selector %s, use name:, role: or tag:' % term)
+        found = _matching(index[kind], pattern)
+        if not found:
+            abort('No hosts match %s' % term)
+        selected.update(found)
+    return [h for h in index['hosts'] if h in selected]
+
+
+def choose(selected):
+    """
+    Remembers the hosts picked to run on and returns their addresses, for
+    env.hosts. Aborts when two of them share an address but not their
+    config, since a run on that address couldn't tell them apart.
+    """
+    _chosen.clear()
+    addresses = []
+    for found in selected:
+        other = _chosen.setdefault(found.address, found)
+        if other is found:
+            addresses.append(found.address)
+        elif other.config != found.config:
+            abort('%s and %s share the address %s but not their config, '
+                  'select one of them.' % (other.name, found.name, found.address))
+    return addresses
+
+
+def current():
+    """The host fabric is connected to, or None when it isn't in the inventory."""
+    host_string = env.host_string or ''
+    # fabric adds the user, louisconf usually doesn't
+    for address in (host_string, host_string.split('@')[-1]):
+        if address in _chosen:
+            return _chosen[address]
+    index = _load()
+    found = index['address'].get(host_string) or \
+        index['address'].get(host_string.split('@')[-1])
+    if not found:
+        return None
+    if [h for h in found if h.config != found[0].config]:
+        abort('%s is the address of %s, which have different configs, '
+              'select the host by name.' % (host_string, ', '.join(h.name for h in found)))
+    return found[0]
+
+
+def hostname():
+    """The current host's name from the inventory, or env.hostname."""
+    found = current()
+    return found and found.name or getattr(env, 'hostname', None)
+
+
+def roles():
+    """The current host's roles."""
+    found = current()
+    return found and found.roles or []
+
+
+class HostConfig(object):
+    """
+    Stands in for env.host_config and answers with the config of whichever
+    host fabric is connected to, so a task running on several hosts reads
+    the right one each time.
+    """
+
+    def _config(self):
+        found = current()
+        return found and found.config or {}
+
+    def get(self, key, default=None):
+        return self._config().get(key, default)
+
+    def __getitem__(self, key):
+        return self._config()[key]
+
+    def __contains__(self, key):
+        return key in self._config()
+
+    def keys(self):
+        return self._config().keys()
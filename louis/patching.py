@@ -0,0 +1,37 @@
+"""
+Helpers to swap functions used by louis after everything was imported.
+
+louis modules bind fabric's operations and each other's tasks by name
+(from fabric.api import run), so replacing them means rebinding those names
+in every module that imported them.
+"""
+import sys
+
+
+def louis_modules():
+    return [m for n, m in sys.modules.items()
+            if m is not None and (n == 'louis' or n.startswith('louis.'))]
+
+
+def rebind(namespace, replacements):
+    """Replaces every value of namespace found in the replacements dict."""
+    for name, value in namespace.items():
+        try:
+            if value in replacements:
+                namespace[name] = replacements[value]
+        except TypeError:
+            # unhashable values can't be something we replace
+            pass
+
+
+def rebind_everywhere(replacements):
+    """
+    Rebinds in every louis module, in fabric.contrib.files (which runs its
+    own commands) and in fab's task table, which the fabfile filled before
+    louis got a chance to replace anything.
+    """
+    from fabric import state
+    from fabric.contrib import files
+    for module in louis_modules() + [files]:
+        rebind(vars(module), replacements)
+    rebind(getattr(state, 'commands', {}), replacements)
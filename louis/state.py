@@ -0,0 +1,118 @@
+"""
+Remembers which provisioning steps already ran on a host.
+
+Every host keeps a small JSON manifest (louisconf.STATE_PATH, by default
+/var/lib/louis/state.json) mapping step names to a fingerprint of the step's
+inputs: its arguments plus whatever the step declares it depends on, such as
+conf values or the contents of local files. A step whose fingerprint matches
+the manifest is skipped, so running init_server again only does the work
+whose inputs changed.
+
+Steps may run in several fab processes at once (see louis.graph), so saving
+only merges this process's entries into the manifest, under a lock.
+"""
+import base64
+import functools
+import hashlib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fabric.api import env, sudo, settings, hide
+from fabric.colors import green
+from louis import conf
+
+_manifests = {}
+
+_MERGE = """
+import fcntl, json, os
+path, entries, replace = %r, %r, %r
+if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+lock = open(path + '.lock', 'w')
+fcntl.flock(lock, fcntl.LOCK_EX)
+try:
+    current = json.load(open(path))
+except (IOError, ValueError):
+    current = {}
+if replace:
+    current = {}
+for name, fingerprint in entries.items():
+    if fingerprint is None:
+        current.pop(name, None)
+    else:
+        current[name] = fingerprint
+temporary = open(path + '.tmp', 'w')
+temporary.write(json.dumps(current, indent=1, sort_keys=True))
+temporary.close()
+os.rename(path + '.tmp', path)
+"""
+
+
+def _path():
+    return getattr(conf, 'STATE_PATH', '/var/lib/louis/state.json')
+
+
+def manifest():
+    """Returns the current host's manifest, reading it once per session."""
+    if env.host_string not in _manifests:
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            content = sudo('cat %s' % _path())
+        try:
+            _manifests[env.host_string] = json.loads(content)
+        except ValueError:
+            _manifests[env.host_string] = {}
+    return _manifests[env.host_string]
+
+
+def save(*names):
+    """
+    Writes the named steps' entries to the host's manifest, or replaces it
+    with this process's manifest when no names are given.
+    """
+    current = manifest()
+    if names:
+        entries = dict((name, current.get(name)) for name in names)
+    else:
+        entries = current
+    script = _MERGE % (_path(), entries, not names)
+    with settings(hide('running', 'stdout')):
+        sudo('echo %s | base64 -d | python' % base64.b64encode(script))
+
+
+def forget(name=None):
+    """Forgets one step, or every step when name is None."""
+    if name is None:
+        manifest().clear()
+        save()
+    else:
+        manifest().pop(name, None)
+        save(name)
+
+
+def step(*inputs):
+    """
+    Decorator for provisioning steps that only need to run again when their
+    inputs change. inputs are callables returning anything with a stable
+    repr(). Set env.force_steps (see the force_steps task) to run every step.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not getattr(conf, 'SKIP_COMPLETED_STEPS', True):
+                return fn(*args, **kwargs)
+            data = [fn.__name__, args, sorted(kwargs.items())]
+            data.extend(i() for i in inputs)
+            fingerprint = hashlib.sha1(repr(data)).hexdigest()
+            if (not getattr(env, 'force_steps', False) and
+                    manifest().get(fn.__name__) == fingerprint):
+                print(green('%s is up to date, skipping.' % fn.__name__))
+                return
+            result = fn(*args, **kwargs)
+            manifest()[fn.__name__] = fingerprint
+            save(fn.__name__)
+            return result
+        return wrapper
+    return decorator
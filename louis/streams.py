@@ -0,0 +1,78 @@
+"""
+Pipes the output of a command on one host into a command on another.
+
+Endpoints are host names from the inventory, reached with the ssh client
+(so ssh-agent and ~/.ssh/config apply), or "local" for this machine. The
+data flows through this process without touching a disk on either side,
+which lets it count the bytes and time every stream. Remote to remote
+streams go through here too, so the hosts don't need ssh access to each
+other. Streams have run() and failed like louis.workers jobs, so
+workers.run_jobs runs several at a time.
+"""
+import subprocess
+import time
+
+from fabric.api import env, abort
+from louis import inventory
+
+CHUNK = 1024 * 1024
+
+
+def command(endpoint, shell_command):
+    """Returns the argv that runs shell_command on endpoint."""
+    if endpoint == 'local':
+        return ['/bin/sh', '-c', shell_command]
+    host, sep, port = inventory.host(endpoint).address.partition(':')
+    argv = ['ssh', '-o', 'BatchMode=yes', '-T']
+    if port:
+        argv.extend(['-p', port])
+    if env.user:
+        host = '%s@%s' % (env.user, host)
+    return argv + [host, shell_command]
+
+
+def output(endpoint, shell_command):
+    """Runs shell_command on endpoint and returns its output."""
+    process = subprocess.Popen(command(endpoint, shell_command),
+                               stdout=subprocess.PIPE)
+    result = process.communicate()[0]
+    if process.returncode:
+        abort('%s failed on %s' % (shell_command, endpoint))
+    return result
+
+
+class Stream(object):
+    """Pipes source_command on source into target_command on target."""
+
+    def __init__(self, name, source, source_command, target, target_command):
+        self.name = name
+        self.source = command(source, source_command)
+        self.target = command(target, target_command)
+        self.transferred = 0
+        self.duration = 0.0
+        self.error = None
+
+    def run(self):
+        start = time.time()
+        reader = subprocess.Popen(self.source, stdout=subprocess.PIPE)
+        writer = subprocess.Popen(self.target, stdin=subprocess.PIPE)
+        try:
+            while True:
+                chunk = reader.stdout.read(CHUNK)
+                if not chunk:
+                    break
+                writer.stdin.write(chunk)
+                self.transferred += len(chunk)
+        except IOError, e:
+            self.error = str(e)
+            reader.kill()
+        writer.stdin.close()
+        if reader.wait() and not self.error:
+            self.error = 'source exited with %d' % reader.returncode
+        if writer.wait() and not self.error:
+            self.error = 'target exited with %d' % writer.returncode
+        self.duration = time.time() - start
+
+    @property
+    def failed(self):
+        return self.error is not None
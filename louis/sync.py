@@ -0,0 +1,101 @@
+"""
+Renders templates locally and ships only the files whose content changed.
+
+A Sync collects files (rendered templates or plain content) with their
+remote destination, owner and mode. run() asks the host for the sha1 of
+every destination in one call, packs the changed files in one tarball, uploads
+it and installs every file with its permissions in one batch, so syncing any
+number of files costs three round trips, or one when nothing changed.
+"""
+from __future__ import with_statement
+import hashlib
+import os
+import tarfile
+import tempfile
+
+from fabric.api import env, sudo, put, settings, hide
+from fabric.colors import green
+import louis.batch
+
+
+def render(template_path, context):
+    """Renders a template the way fabric's upload_template does."""
+    text = open(template_path).read()
+    if context:
+        text = text % context
+    return text
+
+
+class Sync(object):
+
+    def __init__(self):
+        self.files = []
+
+    def add(self, content, destination, owner='root', group=None, mode='644'):
+        self.files.append((content, destination, owner, group or owner, mode))
+
+    def add_template(self, template_path, destination, context, **kwargs):
+        self.add(render(template_path, context), destination, **kwargs)
+
+    def _remote_hashes(self):
+        destinations = ' '.join(f[1] for f in self.files)
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            output = sudo('sha1sum %s 2>/dev/null' % destinations)
+        hashes = {}
+        for line in output.splitlines():
+            digest, sep, path = line.strip().partition('  ')
+            hashes[path] = digest
+        return hashes
+
+    def changed(self):
+        """Returns the files whose remote content differs."""
+        hashes = self._remote_hashes()
+        return [f for f in self.files
+                if hashes.get(f[1]) != hashlib.sha1(f[0]).hexdigest()]
+
+    def _pack(self, files):
+        handle, path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(handle)
+        archive = tarfile.open(path, 'w:gz')
+        try:
+            for number, (content, destination, o, g, m) in enumerate(files):
+                data_handle, data_path = tempfile.mkstemp()
+                try:
+                    os.write(data_handle, content)
+                    os.close(data_handle)
+                    archive.add(data_path, arcname=str(number))
+                finally:
+                    os.remove(data_path)
+        finally:
+            archive.close()
+        return path
+
+    def run(self):
+        """
+        Installs the changed files and returns their destinations, so that
+        callers know what needs reloading.
+        """
+        if not self.files:
+            return []
+        files = self.changed()
+        if not files:
+            print(green('[%s] %d files up to date' % (env.host_string, len(self.files))))
+            return []
+        archive = self._pack(files)
+        batch = louis.batch.Batch()
+        remote_archive = '/tmp/louis-sync-%s.tar.gz' % batch.token[8:]
+        remote_dir = remote_archive[:-len('.tar.gz')]
+        try:
+            put(archive, remote_archive)
+        finally:
+            os.remove(archive)
+        batch.add('mkdir -p %s && tar xzf %s -C %s' % (remote_dir, remote_archive, remote_dir))
+        for number, (content, destination, owner, group, mode) in enumerate(files):
+            batch.add('install -D -o %s -g %s -m %s %s/%d %s' %
+                      (owner, group, mode, remote_dir, number, destination))
+        batch.add('rm -rf %s %s' % (remote_dir, remote_archive))
+        batch.run(quiet=True)
+        changed = [f[1] for f in files]
+        for destination in changed:
+            print(green('[%s] updated %s' % (env.host_string, destination)))
+        return changed
@@ -0,0 +1,177 @@
+"""
+Records where a louis run spends its time.
+
+Once installed, every louis task and every remote operation (run, sudo, put,
+get and local) is timed. Operations are nested under the task that issued
+them and carry their exit status and the bytes they moved. When fab exits,
+the run is saved as a Chrome trace (load it in chrome://tracing) in
+louisconf.TRACE_DIR and the slowest operations are printed.
+"""
+import atexit
+import functools
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fabric.api import env
+from louis import conf
+from louis import patching
+
+OPERATIONS = ('run', 'sudo', 'put', 'get', 'local')
+
+events = []
+_stack = []
+_wrapped = {}
+_started = time.time()
+
+
+def _host():
+    return env.host_string or 'local'
+
+
+def _record(category, name, start, duration, **args):
+    args['task'] = '/'.join(_stack)
+    events.append({
+        'cat': category,
+        'name': name,
+        'host': _host(),
+        'ts': start - _started,
+        'dur': duration,
+        'args': args,
+    })
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def _trace_operation(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = failed = None
+        try:
+            result = fn(*args, **kwargs)
+            failed = getattr(result, 'failed', False)
+            return result
+        finally:
+            duration = time.time() - start
+            if name in ('put', 'get'):
+                local_path = name == 'put' and args[0] or args[1]
+                label = ' '.join(str(a) for a in args[:2])
+                transferred = _size(local_path)
+            else:
+                label = str(args and args[0] or kwargs.get('command'))
+                transferred = len(label) + len(result or '')
+            if failed is None:
+                status = 'error'
+            else:
+                status = failed and 'failed' or 'ok'
+            _record(name, label, start, duration, status=status,
+                    bytes=transferred)
+    return wrapper
+
+
+def _trace_task(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _stack.append(fn.__name__)
+        start = time.time()
+        status = 'error'
+        try:
+            result = fn(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            _stack.pop()
+            _record('task', fn.__name__, start, time.time() - start,
+                    status=status)
+    return wrapper
+
+
+def install():
+    """Starts tracing. Calling it more than once has no effect."""
+    if _wrapped:
+        return
+    from fabric import api
+    for name in OPERATIONS:
+        original = getattr(api, name)
+        _wrapped[original] = _trace_operation(name, original)
+    for module in patching.louis_modules():
+        if not module.__name__.startswith('louis.commands'):
+            continue
+        for name, value in vars(module).items():
+            if (callable(value) and not name.startswith('_') and
+                    getattr(value, '__module__', None) == module.__name__ and
+                    not isinstance(value, type) and value not in _wrapped):
+                _wrapped[value] = _trace_task(value)
+    patching.rebind_everywhere(_wrapped)
+    atexit.register(_finish)
+
+
+def enabled():
+    return bool(_wrapped)
+
+
+def _chrome_trace():
+    hosts = sorted(set(e['host'] for e in events))
+    trace_events = []
+    for number, host in enumerate(hosts):
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                             'tid': number, 'args': {'name': host}})
+    for event in events:
+        trace_events.append({
+            'name': event['name'][:200],
+            'cat': event['cat'],
+            'ph': 'X',
+            'pid': 1,
+            'tid': hosts.index(event['host']),
+            'ts': int(event['ts'] * 1000000),
+            'dur': int(event['dur'] * 1000000),
+            'args': event['args'],
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def save(path=None):
+    directory = getattr(conf, 'TRACE_DIR', 'louis-logs')
+    if path is None:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'trace-%s-%d.json' %
+                            (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    trace_file = open(path, 'w')
+    try:
+        json.dump(_chrome_trace(), trace_file)
+    finally:
+        trace_file.close()
+    return path
+
+
+def summary(top=None):
+    top = int(top or getattr(conf, 'TRACE_TOP', 10))
+    operations = [e for e in events if e['cat'] != 'task']
+    operations.sort(key=lambda e: e['dur'], reverse=True)
+    print('Slowest operations:')
+    for event in operations[:top]:
+        print('  %7.2fs %-5s %-6s %-20s %s' % (
+            event['dur'], event['cat'], event['args']['status'],
+            event['args']['task'][-20:], event['name'][:60]))
+    total = sum(e['dur'] for e in operations)
+    transferred = sum(e['args']['bytes'] for e in operations)
+    print('%d operations, %.1fs, %d bytes' % (len(operations), total,
+                                               transferred))
+
+
+def _finish():
+    if not events:
+        return
+    summary()
+    print('Trace saved in %s' % save())
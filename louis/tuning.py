@@ -0,0 +1,234 @@
+"""
+Sizes apache, mod_wsgi, postgres and memcached for the host they run on.
+
+The numbers come from the host's facts (CPU count and memory) and a few
+louisconf budgets, and every one of them can be overridden per host through
+host_config, e.g. ("1.2.3.4", "web1", {"wsgi-processes": 4}).
+"""
+from fabric.api import env
+from louis import conf
+from louis import facts
+from louis import inventory
+
+MPM_TEMPLATE = """# Generated by louis for %(cpus)d cpus and %(memory_mb)d MB of memory.
+<IfModule mpm_worker_module>
+    ServerLimit          %(mpm_server_limit)d
+    ThreadsPerChild      %(mpm_threads_per_child)d
+    MaxClients           %(mpm_max_clients)d
+</IfModule>
+<IfModule mpm_prefork_module>
+    ServerLimit          %(mpm_prefork_max_clients)d
+    MaxClients           %(mpm_prefork_max_clients)d
+</IfModule>
+"""
+
+
+def _override(key, value):
+    return int(env.host_config.get(key, value))
+
+
+def wsgi_sizing():
+    """
+    Returns the mod_wsgi and MPM numbers for the current host:
+
+    - wsgi_processes: as many daemon processes as fit in
+      louisconf.WSGI_MEMORY_SHARE (0.5) of the memory at
+      louisconf.WSGI_MEMORY_PER_PROCESS_MB (150) each, capped at two per core.
+    - wsgi_threads: louisconf.WSGI_THREADS (15) per process.
+    - mpm_*: enough apache workers for every wsgi thread twice over, so
+      static files and slow clients don't starve the daemons, rounded up to
+      whole MPM children.
+    - mpm_prefork_max_clients: the same for the prefork MPM, which runs a
+      process per client, so no more than fit in
+      louisconf.MPM_PREFORK_MEMORY_SHARE (0.25) of the memory at
+      louisconf.MPM_PREFORK_MEMORY_PER_PROCESS_MB (20) each.
+    """
+    host_facts = facts.get()
+    cpus = max(1, host_facts['cpus'])
+    memory_mb = host_facts['memory_mb']
+    per_process = _override('wsgi-memory-per-process',
+                            getattr(conf, 'WSGI_MEMORY_PER_PROCESS_MB', 150))
+    share = getattr(conf, 'WSGI_MEMORY_SHARE', 0.5)
+    by_memory = int(memory_mb * share) // per_process
+    processes = _override('wsgi-processes', max(1, min(cpus * 2, by_memory)))
+    threads = _override('wsgi-threads', getattr(conf, 'WSGI_THREADS', 15))
+    threads_per_child = _override('mpm-threads-per-child', 25)
+    max_clients = _override('mpm-max-clients',
+                            max(150, processes * threads * 2))
+    server_limit = -(-max_clients // threads_per_child)
+    prefork_by_memory = int(memory_mb * getattr(conf, 'MPM_PREFORK_MEMORY_SHARE', 0.25)) // \
+        getattr(conf, 'MPM_PREFORK_MEMORY_PER_PROCESS_MB', 20)
+    prefork_max_clients = _override('mpm-prefork-max-clients', max(
+        10, min(processes * threads * 2, prefork_by_memory)))
+    return {
+        'cpus': cpus,
+        'memory_mb': memory_mb,
+        'wsgi_processes': processes,
+        'wsgi_threads': threads,
+        'mpm_threads_per_child': threads_per_child,
+        'mpm_server_limit': server_limit,
+        'mpm_max_clients': server_limit * threads_per_child,
+        'mpm_prefork_max_clients': prefork_max_clients,
+    }
+
+
+def pgbouncer_sizing(max_connections=100, superuser_reserved=3):
+    """
+    Returns pgbouncer's pool sizes for the current host: a server connection
+    for every other mod_wsgi thread, since a request spends only part of its
+    time in the database and the rest wait in pgbouncer's queue, but never
+    more, with the reserve pool, than postgres' max_connections allows after
+    its superuser connections and louisconf.PGBOUNCER_DIRECT_CONNECTIONS (5)
+    for cron jobs and psql. Clients may be twice the wsgi threads, so a
+    restart's old and new daemons can overlap. host_config's
+    "pgbouncer-pool-size" and "pgbouncer-max-clients" override them.
+    """
+    sizing = wsgi_sizing()
+    workers = sizing['wsgi_processes'] * sizing['wsgi_threads']
+    available = max(2, int(max_connections) - int(superuser_reserved) -
+                    getattr(conf, 'PGBOUNCER_DIRECT_CONNECTIONS', 5))
+    pool_size = _override('pgbouncer-pool-size', getattr(
+        conf, 'PGBOUNCER_POOL_SIZE',
+        max(1, min(workers // 2, available * 10 // 11))))
+    return {
+        'pgbouncer_pool_size': pool_size,
+        'pgbouncer_reserve_pool_size': max(0, min(pool_size // 10,
+                                                  available - pool_size)),
+        'pgbouncer_max_clients': _override('pgbouncer-max-clients',
+                                           max(100, workers * 2)),
+    }
+
+
+def memcached_sizing():
+    """
+    Returns memcached's limits for the current host: memory_mb, the
+    louisconf.MEMCACHED_MEMORY_SHARE of the memory (0.25 on hosts with the
+    cache role, 0.1 elsewhere, since they also run apache and postgres),
+    a thread per core up to 4 and enough connections for every mod_wsgi
+    thread of the hosts using it. host_config's "memcached-memory",
+    "memcached-threads" and "memcached-connections" override them.
+    """
+    host_facts = facts.get()
+    cpus = max(1, host_facts['cpus'])
+    dedicated = getattr(conf, 'MEMCACHED_ROLE', 'cache') in inventory.roles()
+    share = getattr(conf, 'MEMCACHED_MEMORY_SHARE', dedicated and 0.25 or 0.1)
+    memory = _override('memcached-memory',
+                       max(64, int(host_facts['memory_mb'] * share)))
+    workers = wsgi_sizing()
+    return {
+        'memcached_memory_mb': memory,
+        'memcached_threads': _override('memcached-threads', min(4, cpus)),
+        'memcached_connections': _override(
+            'memcached-connections',
+            max(1024, workers['wsgi_processes'] * workers['wsgi_threads'] * 4)),
+    }
+
+
+# Per workload: max_connections (fewer on small hosts), share of the remaining
+# memory work_mem may take per connection, maintenance_work_mem divisor,
+# checkpoint size and default_statistics_target.
+POSTGRES_PROFILES = {
+    'web': {'max_connections': 200, 'work_mem_share': 3,
+            'maintenance_divisor': 16, 'checkpoint_mb': 512, 'statistics': 100},
+    'mixed': {'max_connections': 100, 'work_mem_share': 2,
+              'maintenance_divisor': 16, 'checkpoint_mb': 1024, 'statistics': 100},
+    'analytics': {'max_connections': 40, 'work_mem_share': 1,
+                  'maintenance_divisor': 8, 'checkpoint_mb': 2048, 'statistics': 500},
+}
+
+# Settings postgres only picks up on a restart, not on a reload.
+POSTGRES_RESTART_SETTINGS = ('shared_buffers', 'max_connections', 'wal_buffers',
+                             'max_worker_processes')
+
+
+def postgres_version(version_string):
+    return tuple(int(part) for part in version_string.split('.'))
+
+
+def postgres_settings(profile, version):
+    """
+    Returns postgresql.conf settings for the host's memory, cores and disk
+    and the given workload profile (web, mixed or analytics), in the units
+    postgres expects. louisconf.POSTGRES_SETTINGS and the host_config's
+    "postgres-settings" dict override single values.
+    """
+    if profile not in POSTGRES_PROFILES:
+        raise ValueError('Unknown postgres profile %r, use one of %s' %
+                         (profile, ', '.join(sorted(POSTGRES_PROFILES))))
+    workload = POSTGRES_PROFILES[profile]
+    host_facts = facts.get()
+    memory_mb = host_facts['memory_mb']
+    cpus = max(1, host_facts['cpus'])
+    ssd = host_facts['disk'] == 'ssd'
+    version = postgres_version(version)
+
+    shared_buffers = memory_mb // 4
+    if version < (9, 3):
+        # System V shared memory needs kernel limits raised for large values
+        shared_buffers = min(shared_buffers, 8192)
+    # work_mem doesn't go below 4MB, so small hosts get fewer connections
+    # for every one of them to fit in memory with its work_mem
+    max_connections = max(10, min(workload['max_connections'],
+                                  (memory_mb - shared_buffers) // 4))
+    work_mem = max(4, (memory_mb - shared_buffers) //
+                   (max_connections * workload['work_mem_share']))
+    settings = {
+        'max_connections': max_connections,
+        'shared_buffers': '%dMB' % shared_buffers,
+        'effective_cache_size': '%dMB' % (memory_mb * 3 // 4),
+        'work_mem': '%dMB' % work_mem,
+        'maintenance_work_mem': '%dMB' % min(2048, max(64, memory_mb // workload['maintenance_divisor'])),
+        'wal_buffers': '16MB',
+        'checkpoint_completion_target': 0.9,
+        'default_statistics_target': workload['statistics'],
+        'random_page_cost': ssd and 1.1 or 4,
+        'effective_io_concurrency': ssd and 200 or 2,
+    }
+    if version < (9, 5):
+        settings['checkpoint_segments'] = workload['checkpoint_mb'] // 16
+    else:
+        settings['max_wal_size'] = '%dMB' % (workload['checkpoint_mb'] * 2)
+        settings['min_wal_size'] = '%dMB' % (workload['checkpoint_mb'] // 2)
+    if version >= (9, 6):
+        settings['max_worker_processes'] = cpus
+        settings['max_parallel_workers_per_gather'] = max(1, cpus // 2)
+    settings.update(getattr(conf, 'POSTGRES_SETTINGS', {}))
+    settings.update(env.host_config.get('postgres-settings', {}))
+    return settings
+
+
+def megabytes(value):
+    value = str(value)
+    for suffix, factor in (('GB', 1024), ('MB', 1), ('kB', 1.0 / 1024)):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * factor
+    return float(value) / 1024
+
+
+def validate_postgres_settings(settings):
+    """Returns a list of problems with settings on the current host."""
+    memory_mb = facts.get()['memory_mb']
+    problems = []
+    shared_buffers = megabytes(settings['shared_buffers'])
+    if shared_buffers > memory_mb * 0.4:
+        problems.append('shared_buffers is more than 40%% of %dMB' % memory_mb)
+    worst_case = shared_buffers + (megabytes(settings['work_mem']) *
+                                   int(settings['max_connections']))
+    if worst_case > memory_mb:
+        problems.append('shared_buffers + work_mem * max_connections is %dMB, '
+                        'more than the %dMB of memory' % (worst_case, memory_mb))
+    return problems
+
+
+def postgres_value(value):
+    """Formats value the way postgresql.conf spells it."""
+    if isinstance(value, basestring):
+        return "'%s'" % value
+    return str(value)
+
+
+def render_postgres_settings(settings, profile):
+    lines = ['# Generated by louis for the %s profile.' % profile]
+    for name in sorted(settings):
+        lines.append('%s = %s' % (name, postgres_value(settings[name])))
+    return '\n'.join(lines) + '\n'
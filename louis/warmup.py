@@ -0,0 +1,143 @@
+"""
+Warms up a project's mod_wsgi daemon processes after a deploy.
+
+Touching the wsgi file or reloading apache leaves every daemon process to
+import Django on its first request, which the first visitors pay for. run()
+sends louisconf.WARMUP_URLS to the vhost on the host itself, a few requests
+per daemon at a time, until every daemon process of the project user has
+loaded the application. Only processes started after the wsgi file was last
+touched run the new code; older ones are still waiting for the request that
+makes them restart. A new process counts as loaded once its resident memory
+grew by louisconf.WARMUP_RSS_GROWTH_MB (5) since it was first seen, or is at
+least louisconf.WARMUP_RSS_MB (30), since a cold daemon is a bare apache
+child. That needs WSGIDaemonProcess to run as the project user.
+
+The whole loop runs on the host in one call and reports how long each
+process took.
+"""
+import base64
+
+from fabric.api import sudo, settings, hide, abort
+from fabric.colors import green, red
+from louis import conf
+
+SCRIPT = r"""
+import os, pwd, sys, threading, time, urllib2
+
+user, server_name, timeout, growth, minimum, concurrency, wsgi_file = sys.argv[1:8]
+urls = sys.argv[8:]
+uid = pwd.getpwnam(user).pw_uid
+timeout, growth, minimum = float(timeout), int(growth), int(minimum)
+page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+ticks = os.sysconf('SC_CLK_TCK')
+boot = time.time() - float(open('/proc/uptime').read().split()[0])
+
+def daemons():
+    found = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            if os.stat('/proc/' + pid).st_uid != uid:
+                continue
+            stat = open('/proc/%s/stat' % pid).read()
+        except (IOError, OSError):
+            continue
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        if name in ('apache2', 'httpd') or 'wsgi' in name:
+            # fields 22 and 24 of stat: start time in ticks since boot, rss
+            fields = stat[stat.rindex(')') + 2:].split()
+            found[int(pid)] = (int(fields[21]) * page_kb // 1024,
+                               boot + float(fields[19]) / ticks)
+    return found
+
+counts = {'requests': 0, 'errors': 0}
+
+def fetch(url):
+    request = urllib2.Request('http://127.0.0.1' + url, headers={'Host': server_name})
+    try:
+        urllib2.urlopen(request, timeout=timeout).read()
+    except urllib2.HTTPError:
+        # an error page still went through Django
+        pass
+    except Exception:
+        counts['errors'] += 1
+    counts['requests'] += 1
+
+start = time.time()
+try:
+    # daemons started before the wsgi file was touched run the old code
+    since = os.stat(wsgi_file).st_mtime
+except OSError:
+    since = start
+first_seen = {}
+warm = {}
+current = {}
+while time.time() - start < timeout:
+    threads = [threading.Thread(target=fetch, args=(url,))
+               for url in urls for n in range(int(concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    current = {}
+    for pid, (rss, started) in daemons().items():
+        current[pid] = rss
+        if started < since:
+            continue
+        first_seen.setdefault(pid, (rss, elapsed))
+        if pid not in warm and (rss - first_seen[pid][0] >= growth or rss >= minimum):
+            warm[pid] = (elapsed, rss)
+    if current and not [p for p in current if p not in warm]:
+        break
+    if not current and elapsed > 5:
+        break
+    time.sleep(0.1)
+for pid in sorted(current):
+    if pid in warm:
+        print 'warm %d %.2f %d' % (pid, warm[pid][0], warm[pid][1])
+    else:
+        print 'cold %d %.2f %d' % (pid, time.time() - start, current[pid])
+print 'requests %d %d' % (counts['requests'], counts['errors'])
+"""
+
+
+def run(project_username, server_name, processes, urls=None, wsgi_file_path=''):
+    """
+    Warms up the daemons of project_username and aborts when some of them
+    are still cold after louisconf.WARMUP_TIMEOUT seconds (60). Daemons
+    older than wsgi_file_path's last change are only counted once they've
+    been replaced.
+    """
+    if urls is None:
+        urls = getattr(conf, 'WARMUP_URLS', ['/'])
+    if not urls:
+        return
+    arguments = [project_username, server_name,
+                 getattr(conf, 'WARMUP_TIMEOUT', 60),
+                 getattr(conf, 'WARMUP_RSS_GROWTH_MB', 5),
+                 getattr(conf, 'WARMUP_RSS_MB', 30),
+                 max(2, int(processes) * 2), wsgi_file_path] + list(urls)
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo('echo %s | base64 -d | python - %s' % (
+                          base64.b64encode(SCRIPT),
+                          ' '.join("'%s'" % a for a in arguments)))
+    if output.failed:
+        abort('Warm-up failed: %s' % output)
+    cold = []
+    for line in output.splitlines():
+        fields = line.split()
+        if fields and fields[0] in ('warm', 'cold'):
+            state, pid, seconds, rss = fields
+            colour = state == 'warm' and green or red
+            print(colour('daemon %s %s after %ss (%s MB)' % (pid, state, seconds, rss)))
+            if state == 'cold':
+                cold.append(pid)
+        elif fields and fields[0] == 'requests':
+            print('%s warm-up requests, %s failed' % (fields[1], fields[2]))
+    if not cold and 'warm ' not in output:
+        print(red('No daemon processes of %s found, WSGIDaemonProcess should run '
+                  'as that user.' % project_username))
+    if cold:
+        abort('%d daemon processes are still cold.' % len(cold))
@@ -0,0 +1,71 @@
+"""
+Builds wheels for the project's requirements once and reuses them.
+
+Wheels are kept locally in louisconf.WHEELHOUSE_DIR (~/.louis/wheelhouse by
+default), one directory and one tarball per sha1 of the requirements file,
+so they are only built again when the requirements change. They're built
+with the local pip unless louisconf.WHEELHOUSE_BUILD_HOST names a host whose
+platform matches the servers, which is needed for packages with C
+extensions when deploying from a different OS. When parallel runs a fab
+process per host, the first one builds while the others wait on a lock.
+"""
+from __future__ import with_statement
+import hashlib
+import os
+import tempfile
+
+from fabric.api import run, put, get, local, settings, cd
+from fabric.colors import green
+from louis import conf
+from louis import workers
+
+
+def requirements_hash(path):
+    return hashlib.sha1(open(path).read()).hexdigest()
+
+
+def _cache_dir():
+    return os.path.expanduser(getattr(conf, 'WHEELHOUSE_DIR',
+                                      '~/.louis/wheelhouse'))
+
+
+def _build_remotely(host, requirements, digest, tarball):
+    remote_dir = '/tmp/louis-wheelhouse-%s-%d' % (digest, os.getpid())
+    with settings(host_string=host):
+        run('mkdir -p %s' % remote_dir)
+        put(requirements, '%s/requirements.txt' % remote_dir)
+        with cd(remote_dir):
+            run('pip wheel --wheel-dir=wheels -r requirements.txt')
+            run('tar czf wheels.tar.gz -C wheels .')
+        get('%s/wheels.tar.gz' % remote_dir, tarball)
+        run('rm -rf %s' % remote_dir)
+
+
+def build(requirements):
+    """
+    Returns the path of a tarball with wheels for every requirement in the
+    local requirements file, building it if it isn't cached yet.
+    """
+    digest = requirements_hash(requirements)
+    tarball = os.path.join(_cache_dir(), '%s.tar.gz' % digest)
+    with workers.locked('%s.lock' % tarball):
+        if os.path.exists(tarball):
+            print(green('Using cached wheelhouse %s' % tarball))
+            return tarball
+        builder = getattr(conf, 'WHEELHOUSE_BUILD_HOST', None)
+        print(green('Building wheelhouse for %s' % requirements))
+        handle, partial = tempfile.mkstemp(suffix='.partial', dir=_cache_dir())
+        os.close(handle)
+        try:
+            if builder:
+                _build_remotely(builder, requirements, digest, partial)
+            else:
+                wheel_dir = os.path.join(_cache_dir(), digest)
+                local('pip wheel --wheel-dir=%s -r %s' % (wheel_dir, requirements))
+                local('tar czf %s -C %s .' % (partial, wheel_dir))
+            os.chmod(partial, 0644)
+            os.rename(partial, tarball)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return tarball
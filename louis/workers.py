@@ -0,0 +1,126 @@
+"""
+A small bounded worker pool used to fan louis tasks out to several hosts.
+
+Fabric keeps its state in a global env, so it is not safe to run tasks in
+threads of the same process. Each job therefore runs a separate `fab`
+process, and the threads here only wait on those processes.
+"""
+import fcntl
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Queue
+
+
+class Job(object):
+    """A unit of work for the pool: a name plus the command line to run."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.output = ''
+        self.returncode = None
+        self.duration = 0.0
+
+    @property
+    def failed(self):
+        return self.returncode != 0
+
+    def run(self):
+        start = time.time()
+        try:
+            process = subprocess.Popen(self.args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            self.output = process.communicate()[0]
+            self.returncode = process.returncode
+        except OSError, e:
+            self.output = str(e)
+            self.returncode = -1
+        self.duration = time.time() - start
+
+
+def fab_command(*tasks):
+    """
+    Returns the command line that runs the given fab tasks with the same
+    fabfile as the current invocation.
+    """
+    from fabric.api import env
+    args = ['fab']
+    fabfile = getattr(env, 'real_fabfile', None)
+    if fabfile:
+        args.extend(['-f', fabfile])
+    args.extend(tasks)
+    return args
+
+
+def run_jobs(jobs, pool_size, callback=None):
+    """
+    Runs the jobs with at most pool_size of them at the same time. The
+    optional callback is called with every job as soon as it finishes.
+    Returns the jobs in the order they were given.
+    """
+    queue = Queue()
+    for job in jobs:
+        queue.put(job)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                job = queue.get_nowait()
+            except Exception:
+                return
+            job.run()
+            if callback:
+                lock.acquire()
+                try:
+                    callback(job)
+                finally:
+                    lock.release()
+
+    threads = []
+    for i in range(max(1, min(int(pool_size), len(jobs)))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # join with a timeout so that ctrl-c still reaches the main thread
+        while thread.isAlive():
+            thread.join(0.5)
+    return jobs
+
+
+@contextmanager
+def locked(path):
+    """
+    Holds an exclusive lock on path, creating it if needed, so that only one
+    of the fab processes sharing this machine does the work at a time.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another process created it first
+            pass
+    lock = open(path, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock.close()
+
+
+def write_logs(jobs, directory):
+    """Saves each job's captured output to directory/<job name>.log"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for job in jobs:
+        log = open(os.path.join(directory, '%s.log' % job.name), 'w')
+        try:
+            log.write(job.output)
+        finally:
+            log.close()